@@ -11,11 +11,7 @@ import utils
 ####  data  ####
 didx = 0
 num_test = 200
-dataset = utils.Dataset(didx, num_test)
-X_train = np.copy(dataset.X_train)
-X_val   = np.copy(dataset.X_val)
-X_test  = np.copy(dataset.X_test)
-del dataset
+dataset = utils.Dataset(didx, num_test, cache=True)
 
 
 ####  vars  ####
@@ -206,25 +202,27 @@ def print_evaluation_results(err, label='Test', retstring=False):
 
 # Data batching
 # =============
-def get_feed_dict(x, b, i=None):
+def get_feed_dict(split_idx, buffers, b, i=None):
     """ get a batch of data to feed model
-    x : input data
+    split_idx : sample indices of data split, eg dataset.train_idx
+    buffers : utils.BatchBuffers, batch is gathered into these
     b : int (batch_size)
     i : current index or iter
         i only used  for indexing algebra on val and test sets
     """
     if i is None:
-        idx = np.random.choice(x.shape[0], b, replace=False)
+        idx = np.random.choice(split_idx, b, replace=False)
     else: # non-training set
-        idx = np.arange(i*b, (i+1)*b)
-    _x_batch = np.copy(x[idx])
-    x_za, x_fpm = _x_batch[...,:6], _x_batch[...,6:]
+        idx = split_idx[i*b:(i+1)*b]
+    x_za, x_fpm = dataset.get_buffered_batch(idx, buffers)
     return {X_in: x_za, Y: x_fpm}
 
+# batch buffers, for evaluation (training ones are sized in model_train)
+eval_buffers  = utils.BatchBuffers(batch_size)
+
 # modeel feeding partials
-get_train_feed = partial(get_feed_dict, X_train, i=None)
-get_val_feed   = partial(get_feed_dict, X_val)
-get_test_feed  = partial(get_feed_dict, X_test)
+get_val_feed   = partial(get_feed_dict, dataset.val_idx, eval_buffers)
+get_test_feed  = partial(get_feed_dict, dataset.test_idx, eval_buffers)
 
 
 #-----------------------------------------------------------------------------#
@@ -233,46 +231,60 @@ get_test_feed  = partial(get_feed_dict, X_test)
 
 # VALIDATION
 def model_validation(bsize):
-    nval = X_val.shape[0] // bsize
+    nval = len(dataset.val_idx) // bsize
     val_hist = np.zeros((nval), dtype=np.float32)
     for i in range(nval):
-        err = sess.run(error, feed_dict=get_val_feed(bsize, i))
+        fdict = get_val_feed(bsize, i)
+        err = sess.run(error, feed_dict=fdict)
+        eval_buffers.release(fdict[X_in])
         val_hist[i] = err
     return val_hist
 
 # TEST
 def model_test(bsize):
-    ntest = X_test.shape[0] // bsize
-    preds_shape = (2,) + X_test.shape[:-1] + (channels[-1],)
+    ntest = len(dataset.test_idx) // bsize
+    preds_shape = (2, len(dataset.test_idx), num_particles, channels[-1])
     test_hist  = np.zeros((ntest), dtype=np.float32)
     test_preds = np.zeros(preds_shape, dtype=np.float32)
     for i in range(ntest):
         j,k = i*bsize, (i+1)*bsize
-        err, pred = sess.run([error, Y_hat], feed_dict=get_test_feed(bsize, i))
+        fdict = get_test_feed(bsize, i)
+        err, pred = sess.run([error, Y_hat], feed_dict=fdict)
         test_hist[i] = err
+        test_preds[0, j:k] = fdict[Y]
         test_preds[1, j:k] = pred
-    test_preds[0] = X_test[...,6:]
+        eval_buffers.release(fdict[X_in])
     print_evaluation_results(test_hist, 'Test')
     return test_hist, test_preds
 
 # TRAIN
-def model_train(num_iters, batch_size, chkpt):
+def model_train(num_iters, batch_size, chkpt, prefetch=4, num_workers=2):
     # Checkpoints (saving, info)
     num_checkpoints = num_iters // chkpt
     is_checkpoint = lambda i: (i+1) % chkpt == 0
     train_hist = np.zeros((num_checkpoints), dtype=np.float32) # val error during train
 
+    # background batching; buffers cover every batch in flight
+    train_buffers = utils.BatchBuffers(batch_size, prefetch + num_workers + 1)
+    get_train_feed = partial(get_feed_dict, dataset.train_idx, train_buffers,
+                             batch_size, i=None)
+    batches = utils.BatchPrefetcher(get_train_feed, depth=prefetch,
+                                    num_workers=num_workers)
+
     # training loop
     for step in range(num_iters):
-        fdict = get_train_feed(batch_size)
+        fdict = batches.get()
         train.run(feed_dict=fdict)
+        train_buffers.release(fdict[X_in])
 
         if is_checkpoint(step):
             # check model performance on val set
             val_error = model_validation(batch_size)
             vmu = val_error.mean()
             print(f"{step+1:>6}: Validation Error = {vmu:.6f}")
+            batches.print_wait_stats()
             train_hist[(step+1) // chkpt - 1] = vmu
+    batches.close()
     return train_hist
 
 
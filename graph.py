@@ -1,8 +1,14 @@
+import os
 import code, sys
+import hashlib
+import time
 import numpy as np
 import tensorflow as tf
 from sklearn.neighbors import kneighbors_graph, radius_neighbors_graph
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.spatial import cKDTree
+
+import utils
 
 
 
@@ -343,6 +349,30 @@ def get_input_features_shift_inv_ZA(init_pos, ZA_displacement, coo, diag, dims):
     return features_out
 
 
+def get_input_features_15op_ZA(init_pos, ZA_displacement, adj):
+    """ edge features over a symmetrized adjacency, eg alist_to_adjacency
+
+    Params
+    ------
+    init_pos : tensor; (b, N, 3)
+        initial positions of the particles
+    ZA_displacement : tensor; (b, N, 3)
+        za displacement vector, broadcast to the diagonal entries
+    adj : dict
+        adjacency index arrays, see shift_inv_15op_layer
+
+    Returns
+    -------
+    edges : tensor; (S, 3)
+        pos[col] - pos[row], plus ZA displacement on the diagonal
+    """
+    pos = tf.reshape(init_pos, (-1, 3))
+    edges = tf.gather(pos, adj["col"]) - tf.gather(pos, adj["row"])
+    za = tf.reshape(ZA_displacement, (-1, 3))
+    diagonal_za = tf.scatter_nd(tf.expand_dims(adj["dia"], axis=1), za, tf.shape(edges))
+    return edges + diagonal_za
+
+
 def get_input_features_shift_inv(X_in, coo, dims):
     """ get edges and nodes with TF ops
     get relative distances of each particle from its M neighbors
@@ -696,28 +726,160 @@ def to_coo_batch(A):
     #confirm_CSR_to_COO_index_integrity(A, COO_feats) # checked out
     return COO_feats
 
+# Neighbor list conversions
+# ========================================
+def alist_to_coo_batch(alist):
+    """ batch COO_feats and diagonals straight from neighbor lists
+
+    Same outputs as to_coo_batch_ZA_diag on the equivalent csrs (and
+    COO_feats[1] == get_indices_from_list_CSR), but computed as one pass
+    of index arithmetic over the whole batch, without scipy
+
+    Params
+    ------
+    alist : ndarray.int; (b, N, K)
+        neighbor indices of each particle, with no missing (-1) entries
+
+    Returns
+    -------
+    COO_feats : ndarray.int32; (3, b*N*K)
+        rows, cols offset by N per sample, and sample (cube) ids
+    diagonals : ndarray.int32; (b*N,)
+        positions of the self-edges in the flattened COO entries
+        (one per particle if neighbor lists include self)
+    """
+    b, N, K = alist.shape
+    cube = np.arange(b, dtype=np.int32)[:,None,None]
+    COO_feats = np.empty((3, b, N, K), dtype=np.int32)
+    COO_feats[0] = np.arange(N, dtype=np.int32)[:,None] + cube * N
+    COO_feats[1] = alist + cube * N
+    COO_feats[2] = cube
+    COO_feats = COO_feats.reshape(3, -1)
+    diagonals = np.flatnonzero(COO_feats[0] == COO_feats[1]).astype(np.int32)
+    return COO_feats, diagonals
+
+def alist_to_adjacency(alist):
+    """ symmetrized, batch-flattened adjacency for shift_inv_15op_layer
+
+    The edge set is the union of the kneighbor edges, their transposes,
+    and self-edges, so every entry (r, c) has a transpose (c, r) and every
+    particle a diagonal. Edges are encoded as int64 keys r*bN + c, which
+    are sorted and deduplicated once. The transposed keys are a
+    permutation of the same set, so the transpose of each entry is
+    found by inverting the argsort of the transposed keys (a sort-join).
+
+    Params
+    ------
+    alist : ndarray.int; (b, N, K)
+        neighbor indices of each particle; -1 entries are ignored
+
+    Returns
+    -------
+    adj : dict(str: ndarray.int32)
+        adj['row'], adj['col'] : (S,) row, col idx of entries, offset by N
+            per sample, sorted by row then col
+        adj['all'] : (S,) sample idx of entries
+        adj['tra'] : (S,) idx of each entry's transpose
+        adj['dia'] : (b*N,) idx of the diagonal entry of each particle
+        adj['dal'] : (b*N,) sample idx of each diagonal entry
+    """
+    b, N, K = alist.shape
+    bN = b * N
+    offset = (np.arange(b, dtype=np.int64) * N)[:,None,None]
+    rows = np.broadcast_to(np.arange(N, dtype=np.int64)[:,None] + offset, alist.shape)
+    cols = alist + offset
+    valid = alist >= 0
+    r, c = rows[valid], cols[valid]
+    diag = np.arange(bN, dtype=np.int64)
+    keys = np.concatenate([r*bN + c, c*bN + r, diag*bN + diag])
+    keys.sort()
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] # unique
+
+    row, col = keys // bN, keys % bN
+    tra = np.empty(len(keys), dtype=np.int64)
+    tra[np.argsort(col*bN + row)] = np.arange(len(keys))
+    adj = dict(row=row, col=col, all=row // N, tra=tra,
+               dia=np.flatnonzero(row == col), # sorted by row, so particle order
+               dal=diag // N)
+    return {k: v.astype(np.int32) for k, v in adj.items()}
+
 #------------------------------------------------------------------------------
 # Graph func wrappers
 #------------------------------------------------------------------------------
 # Graph gets
 # ========================================
-def get_kneighbor_list(X_in, M, offset_idx=False, include_self=True):
+def get_kneighbor_list(X_in, M, offset_idx=False, include_self=True, eps=None):
+    """ kneighbor csr of each sample; from sklearn, or if eps is given, from
+    an (approximate, if eps > 0) KD-tree search, see get_kneighbors
+    """
     b, N, D = X_in.shape
     lst_csrs = []
     #print('nn.get_kneighbor_list\n M: {}, include_self: {}'.format(M, include_self))
     for i in range(b):
-        kgraph = kneighbors_graph(X_in[i,:,:3], M, include_self=include_self).astype(np.float32)
+        if eps is None:
+            kgraph = kneighbors_graph(X_in[i,:,:3], M, include_self=include_self).astype(np.float32)
+        else:
+            kgraph = get_pbc_kneighbors_csr(X_in[i:i+1], M, include_self=include_self,
+                                            boxsize=None, eps=eps)[0]
         if offset_idx:
             kgraph.indices = kgraph.indices + (N * i)
         lst_csrs.append(kgraph)
     return lst_csrs
 
 
+def kneighbor_coo_preprocessor(M, include_self=True, boxsize=None, eps=None):
+    """ per-batch graph preprocessor, eg for utils.BatchPrefetcher workers
+
+    Params
+    ------
+    M : int
+        number of neighbors
+    boxsize : float
+        if given, neighbors are found under periodic boundary conditions
+        in a box of this side (128 for the ZA data)
+    eps : float
+        approximate KD-tree search tolerance, see get_kneighbors;
+        None for exact (sklearn, if not periodic)
+
+    Returns
+    -------
+    preprocess : function
+        batch (b, N, 9) ---> (batch, COO_feats (3, b*N*M), diagonals (b*N,))
+        where the kgraph is made from the ZA positions, grid + ZA displacement
+    """
+    def preprocess(batch):
+        init_pos = batch[...,:3] + batch[...,3:6]
+        if boxsize is None and eps is None:
+            csrs = get_kneighbor_list(init_pos, M, include_self=include_self)
+            COO_feats, diagonals = to_coo_batch_ZA_diag(csrs)
+        else:
+            alist = np.stack([get_kneighbors(x, M, boxsize, include_self, eps=eps or 0)
+                              for x in init_pos])
+            COO_feats, diagonals = alist_to_coo_batch(alist)
+        return batch, COO_feats, diagonals
+    return preprocess
+
+
+def kneighbor_adjacency_preprocessor(M, boxsize=None, eps=0):
+    """ per-batch preprocessor of the adjacency for shift_inv_15op_layer,
+    eg for utils.BatchPrefetcher workers
+
+    batch (b, N, 9) ---> (batch, adj), where the kgraph is made from the
+    ZA positions (approximately, if eps > 0); see alist_to_adjacency
+    """
+    def preprocess(batch):
+        init_pos = batch[...,:3] + batch[...,3:6]
+        alist = np.stack([get_kneighbors(x, M, boxsize, include_self=True, eps=eps)
+                          for x in init_pos])
+        return batch, alist_to_adjacency(alist)
+    return preprocess
+
+
 #=============================================================================
 # RADIUS graph ops
 #=============================================================================
 
-def radius_graph_fn(x, R, include_self=True):
+def radius_graph_fn(x, R, include_self=True, max_neighbors=None):
     """ Wrapper for sklearn.Neighbors.radius_neighbors_graph function
 
     Params
@@ -726,6 +888,9 @@ def radius_graph_fn(x, R, include_self=True):
         input data, where x[:,:3] == particle coordinates
     R : float
         neighborhood search radius
+    max_neighbors : int
+        if given, only the nearest max_neighbors within R are kept, so
+        dense regions stay bounded
 
     Returns
     -------
@@ -733,10 +898,22 @@ def radius_graph_fn(x, R, include_self=True):
         sparse matrix representing each particle's neighboring
         particles within radius R
     """
-    xR_ngraph = radius_neighbors_graph(x[...,:3], R, include_self=include_self)
-    return xR_ngraph.astype(np.float32)
-
-def get_radius_graph_COO(X_in, R):
+    if max_neighbors is None:
+        xR_ngraph = radius_neighbors_graph(x[...,:3], R, include_self=include_self)
+        return xR_ngraph.astype(np.float32)
+
+    # capped: kneighbors within R, -1 padded; the tree bound excludes
+    # distances == R, which sklearn includes
+    N = x.shape[0]
+    alist = get_kneighbors(x, max_neighbors, include_self=include_self,
+                           radius=np.nextafter(R, np.inf))
+    valid = alist >= 0
+    indptr = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+    indices = alist[valid]
+    data = np.ones(len(indices), dtype=np.float32)
+    return csr_matrix((data, indices, indptr), shape=(N, N))
+
+def get_radius_graph_COO(X_in, R, max_neighbors=None):
     """ Normalize radius neighbor graph by number of neighbors
 
     This function prepares a single sample for direct conversion from
@@ -749,7 +926,7 @@ def get_radius_graph_COO(X_in, R):
     N = X_in.shape[0]
     # just easier to diff indptr for now
     # get csr
-    rad_csr = radius_graph_fn(X_in, R)
+    rad_csr = radius_graph_fn(X_in, R, max_neighbors=max_neighbors)
     rad_coo = rad_csr.tocoo()
 
     # diff data for matmul op select
@@ -760,158 +937,778 @@ def get_radius_graph_COO(X_in, R):
     coo = coo_matrix((coo_data, (rad_coo.row, rad_coo.col)), shape=(N, N)).astype(np.float32)
     return coo
 
-def get_radNeighbor_coo_batch(X_in, R):
-    b, N = X_in.shape[:2]
+def get_radNeighbor_coo_batch(X_in, R, max_neighbors=None):
+    """ batch radius graph, as one block-diagonal, degree-normalized coo
 
-    # accumulators
-    coo = get_radNeighbor_coo(X_in[0], R)
-    rows = coo.row
-    cols = coo.col
-    data = coo.data
-
-    for i in range(1, b):
-        # get coo, offset indices
-        coo = get_radNeighbor_coo(X_in[i], R)
-        row = coo.row + (N * i)
-        col = coo.col + (N * i)
-        datum = coo.data
-
-        # concat to what we have
-        rows = np.concatenate((rows, row))
-        cols = np.concatenate((cols, col))
-        data = np.concatenate((data, datum))
-
-    coo = coo_matrix((data, (rows, cols)), shape=(N*b, N*b)).astype(np.float32)
+    The per-sample graphs are built first, so the output can be
+    allocated once at its final size and filled in place, and all rows
+    are normalized by their degree in one step, exactly as
+    get_radius_graph_COO normalizes each sample.
+
+    Params
+    ------
+    X_in : ndarray.float32; (b, N, D)
+        input data, where X_in[...,:3] == particle coordinates
+    R : float
+        neighborhood search radius
+    max_neighbors : int
+        if given, at most this many (nearest) neighbors per particle
+
+    Returns
+    -------
+    coo : scipy.COO; (b*N, b*N)
+        row-normalized adjacency, rows in order, for
+        get_radNeighbor_sparseT_attributes
+    """
+    b, N = X_in.shape[:2]
+    csrs = [radius_graph_fn(X_in[i], R, max_neighbors=max_neighbors)
+            for i in range(b)]
+
+    # preallocate, then fill per sample
+    ends = np.cumsum([csr.nnz for csr in csrs])
+    rows = np.empty((ends[-1],), dtype=np.int32)
+    cols = np.empty((ends[-1],), dtype=np.int32)
+    for i, (csr, q) in enumerate(zip(csrs, ends)):
+        p = q - csr.nnz
+        rows[p:q] = np.repeat(np.arange(N*i, N*(i+1), dtype=np.int32), np.diff(csr.indptr))
+        cols[p:q] = csr.indices + N*i
+
+    # normalize by degree
+    degree = np.bincount(rows, minlength=b*N).astype(np.float32)
+    data = 1 / degree[rows]
+    coo = coo_matrix((data, (rows, cols)), shape=(N*b, N*b))
     return coo
 
 def get_radNeighbor_sparseT_attributes(coo):
-    idx = np.mat([coo.row, coo.col]).transpose()
+    idx = np.stack([coo.row, coo.col], axis=1).astype(np.int64)
     return idx, coo.data, coo.shape
 
-def get_radius_graph_input(X_in, R):
-    coo = get_radNeighbor_coo_batch(X_in, R)
+def get_radius_graph_input(X_in, R, max_neighbors=None):
+    coo = get_radNeighbor_coo_batch(X_in, R, max_neighbors)
     sparse_tensor_attributes = get_radNeighbor_sparseT_attributes(coo)
     return sparse_tensor_attributes
 
 
 
 #=============================================================================
-# boundary utils
+# periodic boundary ops
 #=============================================================================
-def face_outer(particle, bound): # ret shape (1,3)
-    # face only has one coordinate in boundary, so only one relocation
-    ret = bound + particle
-    return ret[None,:]
-
-def edge_outer(particle, bound):
-    # edge has two coordinates in boundary, so 3 relocations (edge, face, face)
-    zero_idx = list(bound).index(0)
-    edge = np.roll(np.array([[0,1,1],[0,1,0],[0,0,1]]), zero_idx, 1)
-    return (edge * bound) + particle
-
-def corner_outer(particle, bound): # ret shape (7, 3)
-    # corner has 3 coordinates in boundary, so 7 relocations:
-    # (corner, edge, edge, edge, face, face, face)
-    corner = np.array([[1,1,1],[1,1,0],[1,0,1],[1,0,0],[0,1,1],[0,1,0],[0,0,1]])
-    return (corner * bound) + particle
-
-def get_outer(particle, bound, num_boundary):
-    assert num_boundary > 0
-    if num_boundary == 1:
-        return face_outer(particle, bound)
-    elif num_boundary == 2:
-        return edge_outer(particle, bound)
-    else:
-        return corner_outer(particle, bound)
 
-def pad_cube_boundaries(x, boundary_threshold):
-    """ check all particles for boundary conditions and
-    relocate boundary particles
-    I wonder if you could just do one corner_outer over the extracted corners
-    in x, edge_outer on extracted edges, and so forth, while saving indices?
-    Args:
-        x (ndarray): data array, shape (n_P, 3)
-    Returns: expanded x, index_list
-    """
-    N, D = x.shape
-    idx_list = np.array([], dtype=np.int32)
-
-    # boundary
-    lower = boundary_threshold
-    upper = 1 - boundary_threshold
-    bound_x = np.where(x >= upper, -1, np.where(x <= lower, 1, 0))
-    bound_x_count = np.count_nonzero(bound_x, axis=-1)
-
-    # get bound and add to clone
-    for idx in range(N):
-        num_boundary = bound_x_count[idx]
-        if num_boundary > 0:
-            # get particles to add to clone
-            outer_particles = get_outer(x[idx], bound_x[idx], num_boundary)
-            # add indices
-            idx_list = np.append(idx_list, [idx] * outer_particles.shape[0])
-            # concat to clone
-            x = np.concatenate((x, outer_particles), axis=0)
-    return x, idx_list
-
-def get_pcube_adjacency_list(x, idx_map, N, K):
-    """ get kneighbor graph from padded cube
-    x is padded cube of shape (M, 3),
-    where M == (N + number of added boundary particles)
-    Args:
-        x (ndarray): padded cube, of shape (M, 3)
-        idx_map (ndarray): shape (M-N,) indices
-        N: number of particles in original cube
-        K: number of nearest neighbors
-    """
-    kgraph = kneighbors_graph(x, K, include_self=True)[:N].indices
-    kgraph_outer = kgraph >= N
-    for k_idx, is_outer in enumerate(kgraph_outer):
-        if is_outer:
-            #code.interact(local=dict(globals(), **locals())) # DEBUGGING-use
-            outer_idx = kgraph[k_idx]
-            kgraph[k_idx] = idx_map[outer_idx - N]
-    return kgraph.reshape(N,K)
-
-
-def get_pcube_csr(x, idx_map, N, K, include_self=False):
-    """ get kneighbor graph from padded cube
-    x is padded cube of shape (M, 3),
-    where M == (N + number of added boundary particles)
-    Args:
-        x (ndarray): padded cube, of shape (M, 3)
-        idx_map (ndarray): shape (M-N,) indices
-        N: number of particles in original cube
-        K: number of nearest neighbors
-    """
-    kgraph = kneighbors_graph(x, K, include_self=include_self)[:N]
-    kgraph_outer_idx = kgraph.indices >= N
-    for k_idx, is_outer in enumerate(kgraph_outer_idx):
-        if is_outer:
-            #code.interact(local=dict(globals(), **locals())) # DEBUGGING-use
-            outer_idx = kgraph.indices[k_idx]
-            kgraph.indices[k_idx] = idx_map[outer_idx - N]
-    return kgraph
-
-def get_pbc_kneighbors_csr(X, K, boundary_threshold, include_self=False):
-    """
-    """
-    # get boundary range
-    lower = boundary_threshold
-    upper = 1 - boundary_threshold
-    mb_size, N, D = X.shape
-
-    # graph init
-    #adjacency_list = np.zeros((mb_size, N, K), dtype=np.int32)
-    csr_list = []
-    clone = np.copy(X[...,:3])
+def wrap_periodic(x, boxsize):
+    """ wrap coordinates into [0, boxsize), as required by cKDTree(boxsize=)
 
-    for b in range(mb_size):
-        # get expanded cube
-        clone_cube = clone[b]
-        padded_cube, idx_map = pad_cube_boundaries(clone_cube, boundary_threshold)
+    Periodic distances are unchanged by the wrap, so x may be in any
+    box of side boxsize, eg the centered [-64, 64) Lagrangian box.
+    """
+    x = np.mod(x, boxsize)
+    x[x >= boxsize] = 0 # mod may round up to boxsize for tiny negatives
+    return x
+
+def get_kneighbors(x, K, boxsize=None, include_self=False, radius=None,
+                   workers=-1, eps=0):
+    """ kneighbors of every particle, from a KD-tree
+
+    Params
+    ------
+    x : ndarray.float32; (N, D)
+        input data, where x[:,:3] == particle coordinates
+    K : int
+        number of neighbors
+    boxsize : float
+        side of the periodic box; None for non-periodic neighbors
+    include_self : bool
+        whether each particle is its own (first) neighbor
+    radius : float
+        if given, only neighbors within radius; the rest of the K are -1
+    workers : int
+        threads for the query, -1 for all cores
+    eps : float
+        approximate search if > 0: the k-th neighbor returned is within
+        (1 + eps) of the true k-th distance, and the search prunes more of
+        the tree; the recall/speed knob, see report_approx_recall
 
-        # get neighbors from padded_cube
-        kgraph = get_pcube_csr(padded_cube, idx_map, N, K, include_self)
-        csr_list.append(kgraph)
+    Returns
+    -------
+    alist : ndarray.int32; (N, K)
+        neighbor indices of each particle, nearest first
+    """
+    N = x.shape[0]
+    pos = x[:,:3] if boxsize is None else wrap_periodic(x[:,:3], boxsize)
+    tree = cKDTree(pos, boxsize=boxsize)
+    M = K - 1 if include_self else K
+    bound = np.inf if radius is None else radius
+    _, alist = tree.query(tree.data, M + 1, eps=eps, distance_upper_bound=bound,
+                          workers=workers)
+
+    # drop self (or the furthest, if self is tied out of the M+1 by
+    # duplicate points), and put it first if included
+    alist = alist.reshape(N, M + 1)
+    is_self = alist == np.arange(N)[:,None]
+    is_self[~is_self.any(axis=1), -1] = True
+    alist = alist[~is_self].reshape(N, M)
+    if include_self:
+        alist = np.concatenate([np.arange(N)[:,None], alist], axis=1)
+    alist[alist == N] = -1 # no neighbor within radius
+    return alist.astype(np.int32)
+
+def get_pbc_kneighbors(x, K, boxsize=1., include_self=False, eps=0):
+    """ kneighbors of every particle under periodic boundary conditions;
+    (N, K) neighbor indices, nearest first, see get_kneighbors
+
+    Uses a box-periodic KD-tree, so no boundary particles are cloned.
+    """
+    return get_kneighbors(x, K, boxsize, include_self, eps=eps)
+
+def get_pbc_kneighbors_csr(X, K, boundary_threshold=None, include_self=False,
+                           boxsize=1., eps=0):
+    """ periodic kneighbor graphs for a batch
+
+    boundary_threshold is unused, and only kept for older callers; the
+    periodic KD-tree finds neighbors across every boundary.
+
+    Params
+    ------
+    X : ndarray.float32; (b, N, D)
+        input data, where X[...,:3] == particle coordinates
+
+    Returns
+    -------
+    csr_list : list(scipy.CSR); (N, N) each
+        one kneighbors graph per sample, in the format of
+        sklearn.neighbors.kneighbors_graph
+    """
+    mb_size, N = X.shape[:2]
+    indptr = np.arange(0, N*K + 1, K)
+    csr_list = []
+    for b in range(mb_size):
+        alist = get_pbc_kneighbors(X[b], K, boxsize, include_self, eps)
+        data = np.ones((N*K,), dtype=np.float32)
+        csr_list.append(csr_matrix((data, alist.ravel(), indptr), shape=(N, N)))
     return csr_list
+
+
+#=============================================================================
+# static Lagrangian graph
+#=============================================================================
+
+class LagrangianGraph:
+    """ kneighbor adjacency of the fixed Lagrangian grid, built once
+
+    Graphs made on the Lagrangian positions are identical for every
+    sample, so the (periodic) kneighbor list is computed once, cached on
+    disk, and the batch index arrays are tiled from it with offsets,
+    memoized per batch size (see alist_to_coo_batch). Nothing is rebuilt
+    in the training loop.
+
+    Outputs match `to_coo_batch_ZA_diag` on the same graphs, so they can
+    be fed directly to `model_func_shift_inv_za`, and the adjacency dicts
+    (get_adjacency_batch) match `alist_to_adjacency`, for
+    `model_func_15op_shift_inv_za`.
+
+    Params
+    ------
+    grid : ndarray.float32; (N, 3)
+        Lagrangian positions, in the particle order of the batches,
+        eg utils.Dataset.grid (or grid[dataset.perm])
+    K : int
+        number of neighbors
+    boxsize : float
+        side of the periodic box; None for non-periodic neighbors
+    include_self : bool
+        whether particles are their own neighbors (needed for diagonals)
+    cache_dir : str
+        where the kneighbor list is cached; None to not cache
+    """
+    def __init__(self, grid, K, boxsize=128., include_self=True,
+                 cache_dir=utils.GRAPH_CACHE_DIR):
+        self.N = grid.shape[0]
+        self.K = K
+        self.alist = self.load_alist(grid, K, boxsize, include_self, cache_dir)
+        self.nearest_first = boxsize is not None # sklearn lists are col-sorted
+        self._coo = {}
+        self._adj = {}
+
+    @staticmethod
+    def get_cache_path(grid, K, boxsize, include_self, cache_dir):
+        key = hashlib.md5(np.ascontiguousarray(grid, dtype=np.float32).tobytes())
+        key.update(str((K, boxsize, include_self)).encode())
+        return f'{cache_dir}/lagrangian_K{K}_{key.hexdigest()[:8]}.npy'
+
+    @classmethod
+    def load_alist(cls, grid, K, boxsize, include_self, cache_dir):
+        """ kneighbor list of grid from cache, building and caching it if missing """
+        path = None
+        if cache_dir is not None:
+            path = cls.get_cache_path(grid, K, boxsize, include_self, cache_dir)
+            if os.path.exists(path):
+                return np.load(path).astype(np.int32)
+        if boxsize is None:
+            csr = get_kneighbor_list(grid[None], K, include_self=include_self)[0]
+            alist = csr.nonzero()[1].reshape(-1, K).astype(np.int32) # coo order
+        else:
+            alist = get_pbc_kneighbors(grid, K, boxsize, include_self)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f'{path[:-4]}.tmp{os.getpid()}.npy'
+            compact = grid.shape[0] <= np.iinfo(COMPACT_DTYPE).max + 1
+            np.save(tmp, alist_to_compact(alist) if compact else alist)
+            os.replace(tmp, path)
+            print("\nWrote Lagrangian graph to:\n\t" + path + '\n')
+        return alist
+
+    def get_coo_batch(self, b, k=None, dilation=1):
+        """ batch COO_feats and diagonals, tiled from the single sample graph
+
+        k, dilation select a sub-neighborhood of the K, see neighbor_scale
+
+        Returns
+        -------
+        COO_feats : ndarray.int32; (3, b*N*k)
+            rows, cols offset by N per sample, and sample (cube) ids
+        diagonals : ndarray.int32; (b*N,)
+            positions of the self-edges in the flattened COO entries
+        """
+        key = (b, k, dilation)
+        if key not in self._coo:
+            alist = self.get_alist(k, dilation)
+            alist = np.broadcast_to(alist, (b,) + alist.shape)
+            self._coo[key] = alist_to_coo_batch(alist)
+        return self._coo[key]
+
+    def get_alist(self, k=None, dilation=1):
+        if (k, dilation) == (None, 1):
+            return self.alist
+        assert self.nearest_first, 'scales need nearest-first (periodic) lists'
+        return neighbor_scale(self.alist, k or self.K, dilation)
+
+    def get_adjacency_batch(self, b, k=None, dilation=1):
+        """ batch adjacency dict, tiled from the single sample adjacency
+
+        Sample s has the single sample entries with rows, cols and
+        diagonals offset by s*N, entry indices (tra, dia) by s*S, and
+        sample idx s (all, dal), as alist_to_adjacency makes them
+
+        Returns
+        -------
+        adj : dict(str: ndarray.int32)
+            row, col, all, tra, dia, dal; see alist_to_adjacency
+        """
+        key = (b, k, dilation)
+        if key not in self._adj:
+            adj = alist_to_adjacency(self.get_alist(k, dilation)[None])
+            S = len(adj['row'])
+            sample = np.arange(b, dtype=np.int32)[:,None]
+            tile = lambda v, step: (v + sample * step).ravel()
+            self._adj[key] = dict(row=tile(adj['row'], self.N),
+                                  col=tile(adj['col'], self.N),
+                                  all=np.repeat(sample.ravel(), S),
+                                  tra=tile(adj['tra'], S),
+                                  dia=tile(adj['dia'], S),
+                                  dal=np.repeat(sample.ravel(), self.N))
+        return self._adj[key]
+
+    def preprocess(self, batch):
+        """ drop-in for kneighbor_coo_preprocessor, without any graph building """
+        return (batch,) + self.get_coo_batch(len(batch))
+
+    def preprocess_adjacency(self, batch):
+        """ drop-in for kneighbor_adjacency_preprocessor, without any graph building """
+        return batch, self.get_adjacency_batch(len(batch))
+
+
+#=============================================================================
+# multi-scale neighborhoods
+#=============================================================================
+
+def neighbor_scale(alist, k, dilation=1):
+    """ k-neighborhood of nearest-first neighbor lists, from a larger K
+
+    Entries 0, d, 2d, ..., (k-1)d of each list, so self (entry 0, if
+    included) is kept, dilation 1 is the k nearest, and larger dilations
+    span the neighborhood of the (k-1)d + 1 nearest with k neighbors.
+    Works the same on ndarrays and tensors.
+
+    Params
+    ------
+    alist : ndarray.int | tensor.int; (..., K)
+        neighbor lists, nearest first, eg get_kneighbors
+    k : int
+        neighbors per particle; (k-1)*dilation < K
+    dilation : int
+        stride over the sorted neighbors
+
+    Returns
+    -------
+    alist_k : ndarray.int | tensor.int; (..., k)
+    """
+    assert (k - 1) * dilation < alist.shape[-1], 'K too small for scale'
+    return alist[..., :(k - 1)*dilation + 1:dilation]
+
+class NeighborScales:
+    """ nested and dilated neighborhoods of a batch, from one K_max query
+
+    The graph index arrays of each scale (k, dilation) are derived by
+    slicing the sorted neighbor lists, and memoized, so a K sweep or a
+    multi-scale model pays for a single neighbor search.
+
+    Params
+    ------
+    alist : ndarray.int; (b, N, K_max)
+        neighbor lists, nearest first, eg get_kneighbors (any eps),
+        VerletList, or Dataset.get_graph_batch; not sklearn csrs
+    """
+    def __init__(self, alist):
+        self.alist = alist
+        self._coo = {}
+        self._adj = {}
+
+    @classmethod
+    def from_positions(cls, pos, K_max, boxsize=None, include_self=True, eps=0):
+        """ single K_max query over a batch of positions (b, N, 3) """
+        return cls(np.stack([get_kneighbors(x, K_max, boxsize, include_self, eps=eps)
+                             for x in pos]))
+
+    def get_alist(self, k, dilation=1):
+        return neighbor_scale(self.alist, k, dilation)
+
+    def get_coo_batch(self, k, dilation=1):
+        """ COO_feats, diagonals of scale (k, dilation), see alist_to_coo_batch """
+        if (k, dilation) not in self._coo:
+            self._coo[k, dilation] = alist_to_coo_batch(self.get_alist(k, dilation))
+        return self._coo[k, dilation]
+
+    def get_adjacency(self, k, dilation=1):
+        """ adj dict of scale (k, dilation), see alist_to_adjacency """
+        if (k, dilation) not in self._adj:
+            self._adj[k, dilation] = alist_to_adjacency(self.get_alist(k, dilation))
+        return self._adj[k, dilation]
+
+def multiscale_coo_preprocessor(scales, boxsize=None, eps=0):
+    """ per-batch preprocessor of COO_feats and diagonals at several scales,
+    from one neighbor query at the largest, eg for utils.BatchPrefetcher
+
+    Params
+    ------
+    scales : list((int, int))
+        (k, dilation) of each neighborhood, eg [(8, 1), (14, 1), (8, 2)]
+
+    Returns
+    -------
+    preprocess : function
+        batch (b, N, 9) ---> (batch, {(k, dilation): (COO_feats, diagonals)})
+        where the kgraphs are made from the ZA positions
+    """
+    K_max = max((k - 1)*d + 1 for k, d in scales)
+    def preprocess(batch):
+        init_pos = batch[...,:3] + batch[...,3:6]
+        graphs = NeighborScales.from_positions(init_pos, K_max, boxsize, eps=eps)
+        return batch, {scale: graphs.get_coo_batch(*scale) for scale in scales}
+    return preprocess
+
+
+#=============================================================================
+# incremental neighbor lists
+#=============================================================================
+
+def min_image(d, boxsize=None):
+    """ displacements d under the minimum image convention (as is, if not periodic) """
+    if boxsize is None:
+        return d
+    shift = np.rint(d * (1 / boxsize))
+    shift *= boxsize
+    return d - shift
+
+class VerletList:
+    """ kneighbor lists of one sample, kept up to date across rollout steps
+
+    Each particle keeps C >= K candidates, its C nearest at the time it was
+    last queried; the distance to the C-th candidate, less what the
+    particles have moved since, is its skin. On update, the K nearest are
+    selected among the candidates, which is exact as long as
+
+        d_K(now) < d_C(queried) - |moved_i| - max_j |moved_j| (then and now)
+
+    where particle moves are measured against the positions of the last
+    full build. Only the particles that fail this are requeried, on a
+    tree of the current positions; if more than rebuild_frac fail,
+    everything is rebuilt.
+
+    Params
+    ------
+    K : int
+        number of neighbors
+    num_candidates : int
+        candidates kept per particle, C; more is a thicker skin
+        (fewer requeries) at more work per update
+    boxsize : float
+        side of the periodic box; None for non-periodic neighbors
+    include_self : bool
+        whether each particle is its own (first) neighbor
+    rebuild_frac : float
+        fraction of stale particles above which lists are fully rebuilt
+
+    Attrs
+    -----
+    num_builds, num_requeried : int
+        full rebuilds, and particles requeried in partial rebuilds
+    """
+    def __init__(self, K, num_candidates=None, boxsize=None, include_self=True,
+                 rebuild_frac=0.25):
+        self.K = K
+        self.C = 2*K if num_candidates is None else num_candidates
+        assert self.C >= K + (not include_self)
+        self.boxsize = boxsize
+        self.include_self = include_self
+        self.rebuild_frac = rebuild_frac
+        self.num_builds = 0
+        self.num_requeried = 0
+        self.x0 = None
+
+    def sqdist(self, a, b):
+        d = min_image(a - b, self.boxsize)
+        return np.einsum('...i,...i->...', d, d)
+
+    def dist(self, a, b):
+        return np.sqrt(self.sqdist(a, b))
+
+    def query(self, x, idx, max_moved):
+        """ (re)query the candidates of particles idx at positions x """
+        pos = x if self.boxsize is None else wrap_periodic(x, self.boxsize)
+        tree = cKDTree(pos, boxsize=self.boxsize)
+        d, cand = tree.query(pos[idx], self.C, workers=-1)
+        self.candidates[idx] = cand.reshape(len(idx), self.C)
+        self.bound[idx] = d.reshape(len(idx), self.C)[:,-1]
+        self.x_queried[idx] = x[idx]
+        self.moved_queried[idx] = max_moved
+
+    def build(self, x):
+        """ full rebuild, positions x become the reference """
+        N = x.shape[0]
+        self.x0 = x.copy()
+        self.candidates = np.empty((N, self.C), dtype=np.int64)
+        self.bound = np.empty((N,), dtype=x.dtype)
+        self.x_queried = np.empty_like(x)
+        self.moved_queried = np.zeros((N,), dtype=x.dtype)
+        self.query(x, np.arange(N), 0)
+        self.num_builds += 1
+
+    def update(self, x):
+        """ kneighbors at new positions
+
+        Params
+        ------
+        x : ndarray.float32; (N, D)
+            particle data, where x[:,:3] == current particle coordinates
+
+        Returns
+        -------
+        alist : ndarray.int32; (N, K)
+            neighbor indices of each particle, nearest first
+        """
+        x = np.array(x[:,:3], dtype=np.float64) # cKDTree precision, so ties agree
+        N = x.shape[0]
+        if self.x0 is None:
+            self.build(x)
+        max_moved = self.dist(x, self.x0).max()
+
+        # stale particles may have lost a true neighbor outside candidates
+        d = self.sqdist(x[self.candidates], x[:,None])  # (N, C), squared
+        if not self.include_self:
+            d[self.candidates == np.arange(N)[:,None]] = np.inf
+        d_K = np.sqrt(np.partition(d, self.K - 1, axis=1)[:, self.K - 1])
+        skin = (self.bound - self.dist(x, self.x_queried)
+                - max_moved - self.moved_queried)
+        stale = np.flatnonzero(d_K >= skin)
+        if len(stale) > self.rebuild_frac * N:
+            self.build(x)
+            return self.update(x)
+        if len(stale) > 0:
+            self.query(x, stale, max_moved)
+            self.num_requeried += len(stale)
+            d[stale] = self.sqdist(x[self.candidates[stale]], x[stale,None])
+            if not self.include_self:
+                d[stale] = np.where(self.candidates[stale] == stale[:,None], np.inf, d[stale])
+
+        # K nearest candidates, in order
+        nearest = np.argsort(d, axis=1, kind='stable')[:, :self.K]
+        alist = np.take_along_axis(self.candidates, nearest, axis=1)
+        return alist.astype(np.int32)
+
+
+#=============================================================================
+# approximate neighbor search
+#=============================================================================
+
+def get_recall(alist, alist_exact, include_self=False):
+    """ mean fraction of the exact neighbors found, per particle
+
+    If include_self, column 0 (the particle itself, always found) is not
+    counted; missing (-1) exact neighbors are not counted either
+    """
+    if include_self:
+        alist, alist_exact = alist[...,1:], alist_exact[...,1:]
+    hits = (alist[...,None,:] == alist_exact[...,:,None]).any(axis=-1)
+    valid = alist_exact >= 0
+    return hits[valid].mean()
+
+def report_approx_recall(X, K, eps_values=(0.5, 1, 2), boxsize=None,
+                         include_self=True):
+    """ measure recall and time of approximate kneighbors (get_kneighbors
+    with eps > 0) against exact, eg on a held-out batch, to choose eps
+
+    Params
+    ------
+    X : ndarray.float32; (b, N, D)
+        batch, where X[...,:3] == particle coordinates
+
+    Returns
+    -------
+    results : dict(float: (float, float))
+        eps ---> (recall, seconds per sample); eps 0 is exact
+    """
+    results = {}
+    for eps in (0,) + tuple(eps_values):
+        t = time.time()
+        alist = np.stack([get_kneighbors(x, K, boxsize, include_self, eps=eps)
+                          for x in X])
+        elapsed = (time.time() - t) / len(X)
+        if eps == 0:
+            exact = alist
+        results[eps] = (get_recall(alist, exact, include_self), elapsed)
+    print(f'\nApprox kneighbors, K = {K}, N = {X.shape[1]}:')
+    for eps, (recall, elapsed) in results.items():
+        print(f'\teps {eps:<5g}: recall {recall:.4f}, {elapsed:.3f}s per sample')
+    return results
+
+
+#=============================================================================
+# in-graph neighbor search
+#=============================================================================
+# TF ops mirroring the host graph builders, so positions ---> adjacency
+# ---> loss is a single session call, with nothing fed back from the host
+
+CELL_OFFSETS = np.stack(np.meshgrid(*[[-1, 0, 1]]*3, indexing='ij'), -1).reshape(-1, 3)
+
+def tf_periodic_kneighbors(pos, K, boxsize=128., cell_size=8., max_per_cell=32,
+                           include_self=True):
+    """ kneighbors in the periodic box, by cell binning, as TF ops
+
+    Particles are binned into cells of side >= cell_size, and the
+    neighbors of each particle are the K nearest (tf.nn.top_k) among the
+    particles of its own and the 26 adjacent cells. This is exact when
+    cell_size is at least the K-th neighbor distance (~6 for K = 14 in
+    the ZA box) and no cell holds more than max_per_cell particles;
+    cells beyond the cap drop their extra particles.
+
+    Params
+    ------
+    pos : tensor.float32; (b, N, 3)
+        particle coordinates, any box of side boxsize
+    K : int
+        number of neighbors
+    boxsize : float
+        side of the periodic box
+    cell_size : float
+        minimum cell side; boxsize / cell_size must be >= 3
+    max_per_cell : int
+        static cap on particles per cell; candidates are 27*max_per_cell
+    include_self : bool
+        whether each particle is its own (first) neighbor
+
+    Returns
+    -------
+    alist : tensor.int32; (b*N, K)
+        neighbor indices of each particle, offset by N per sample (ie,
+        indices into the flattened batch), nearest first. If a particle
+        has fewer than K candidates, the missing entries are -1, and are
+        dropped by tf_alist_to_coo and tf_alist_to_adjacency.
+    """
+    G = int(boxsize // cell_size) # cells per side
+    assert G >= 3, 'need at least 3 cells per side'
+    h = boxsize / G
+    N = tf.shape(pos)[1]
+    x = tf.reshape(tf.floormod(pos, boxsize), (-1, 3)) # (bN, 3)
+    bN = tf.shape(x)[0]
+    idx = tf.range(bN)
+    sample = idx // N
+
+    #==== cell table, (b*G**3, max_per_cell) particle indices, -1 if empty
+    cell = tf.clip_by_value(tf.cast(tf.floor(x / h), tf.int32), 0, G - 1)
+    key = sample * G**3 + (cell[:,0]*G + cell[:,1])*G + cell[:,2]
+    num_keys = (bN // N) * G**3
+    order = tf.argsort(key, stable=True)
+    sorted_key = tf.gather(key, order)
+    starts = tf.cumsum(tf.unsorted_segment_sum(tf.ones_like(key), key, num_keys),
+                       exclusive=True)
+    rank = idx - tf.gather(starts, sorted_key)
+    keep = rank < max_per_cell
+    slots = tf.stack([tf.boolean_mask(sorted_key, keep), tf.boolean_mask(rank, keep)], axis=1)
+    table = tf.scatter_nd(slots, tf.boolean_mask(order, keep) + 1,
+                          tf.stack([num_keys, max_per_cell])) - 1
+
+    #==== candidates from the 27 adjacent cells
+    ncell = tf.floormod(cell[:,None,:] + tf.constant(CELL_OFFSETS, tf.int32), G)
+    nkey = sample[:,None] * G**3 + (ncell[...,0]*G + ncell[...,1])*G + ncell[...,2]
+    cand = tf.reshape(tf.gather(table, nkey), (bN, 27 * max_per_cell))
+    d = tf.gather(x, tf.maximum(cand, 0)) - x[:,None]
+    d = d - boxsize * tf.round(d / boxsize) # minimum image
+    d2 = tf.reduce_sum(tf.square(d), axis=-1)
+    invalid = tf.logical_or(cand < 0, tf.equal(cand, idx[:,None]))
+    d2 = tf.where(invalid, tf.fill(tf.shape(d2), np.inf), d2)
+
+    #==== K nearest
+    M = K - 1 if include_self else K
+    neg_d2, nearest = tf.nn.top_k(-d2, k=M) # sorted, nearest first
+    rows = tf.tile(idx[:,None], [1, M])
+    alist = tf.gather_nd(cand, tf.stack([rows, nearest], axis=-1))
+    alist = tf.where(tf.is_inf(neg_d2), -tf.ones_like(alist), alist) # too few candidates
+    if include_self:
+        alist = tf.concat([idx[:,None], alist], axis=1)
+    return alist
+
+def tf_alist_to_coo(alist, N):
+    """ COO_feats and diagonals from in-graph neighbor lists, as
+    alist_to_coo_batch makes them on the host; missing (-1) entries
+    are dropped
+
+    Params
+    ------
+    alist : tensor.int32; (b*N, K)
+        flattened-batch neighbor indices, eg tf_periodic_kneighbors
+
+    Returns
+    -------
+    COO_feats : tensor.int32; (3, E)
+        rows, cols, and sample (cube) ids; E = b*N*K without missing
+    diagonals : tensor.int32; (b*N,)
+        positions of the self-edges in the flattened COO entries
+    """
+    bN, K = tf.shape(alist)[0], tf.shape(alist)[1]
+    rows = tf.reshape(tf.tile(tf.range(bN)[:,None], [1, K]), [-1])
+    cols = tf.reshape(alist, [-1])
+    valid = cols >= 0
+    rows, cols = tf.boolean_mask(rows, valid), tf.boolean_mask(cols, valid)
+    COO_feats = tf.stack([rows, cols, rows // N])
+    diagonals = tf.cast(tf.where(tf.equal(rows, cols))[:,0], tf.int32)
+    return COO_feats, diagonals
+
+def tf_alist_to_adjacency(alist, N):
+    """ symmetrized adjacency dict for shift_inv_15op_layer, as TF ops;
+    mirrors alist_to_adjacency (sorted int64 keys, transpose by inverting
+    the argsort of the transposed keys)
+
+    Params
+    ------
+    alist : tensor.int32; (b*N, K)
+        flattened-batch neighbor indices, eg tf_periodic_kneighbors
+    N : int | tensor.int32
+        number of particles per sample
+
+    Returns
+    -------
+    adj : dict(str: tensor.int32)
+        row, col, all, tra, dia, dal; see shift_inv_15op_layer
+    """
+    bN, K = tf.shape(alist)[0], tf.shape(alist)[1]
+    bN64, N64 = tf.cast(bN, tf.int64), tf.cast(N, tf.int64)
+    r = tf.cast(tf.reshape(tf.tile(tf.range(bN)[:,None], [1, K]), [-1]), tf.int64)
+    c = tf.cast(tf.reshape(alist, [-1]), tf.int64)
+    r, c = tf.boolean_mask(r, c >= 0), tf.boolean_mask(c, c >= 0) # drop missing
+    diag = tf.range(bN64)
+    keys = tf.sort(tf.concat([r*bN64 + c, c*bN64 + r, diag*bN64 + diag], axis=0))
+    keys, _ = tf.unique(keys) # sorted input, so stays sorted
+
+    row, col = keys // bN64, keys % bN64
+    tra = tf.invert_permutation(tf.cast(tf.argsort(col*bN64 + row), tf.int32))
+    adj = dict(row=row, col=col, all=row // N64, tra=tra,
+               dia=tf.where(tf.equal(row, col))[:,0], dal=diag // N64)
+    return {k: tf.cast(v, tf.int32) for k, v in adj.items()}
+
+
+def tf_edge_features_pbc_ZA(init_pos, ZA_displacement, COO_feats, diagonals,
+                            boxsize=128.):
+    """ edge features over any number of neighbors per particle, as
+    get_input_features_shift_inv_ZA, with minimum-image edges
+
+    Params
+    ------
+    init_pos : tensor; (b, N, 3)
+        initial positions on the grid
+    ZA_displacement : tensor; (b, N, 3)
+        za displacement vector, broadcast to the diagonal entries
+    COO_feats, diagonals : tensor.int32; (3, E), (b*N,)
+        eg tf_alist_to_coo
+
+    Returns
+    -------
+    edges : tensor; (E, 3)
+        pos[col] - pos[row] in the periodic box, plus ZA displacement on
+        the diagonal
+    """
+    pos = tf.reshape(init_pos, (-1, 3))
+    edges = tf.gather(pos, COO_feats[1]) - tf.gather(pos, COO_feats[0])
+    edges = edges - boxsize * tf.round(edges / boxsize) # minimum image
+    za = tf.reshape(ZA_displacement, (-1, 3))
+    diagonal_za = tf.scatter_nd(tf.expand_dims(diagonals, axis=1), za, tf.shape(edges))
+    return edges + diagonal_za
+
+
+#=============================================================================
+# compact neighbor lists
+#=============================================================================
+# Fixed-K graphs stored and fed as per-sample uint16 columns only, (b, N, K);
+# rows are implicit in the layout, and batch offsets and cube ids are rebuilt
+# in-graph. 2 bytes per edge, against 12 for int32 COO_feats.
+
+COMPACT_DTYPE = np.uint16
+
+def alist_to_compact(alist):
+    """ per-sample neighbor lists as compact uint16 columns
+
+    Params
+    ------
+    alist : ndarray.int; (..., N, K)
+        per-sample neighbor indices, with no missing (-1) entries,
+        and N <= 2**16
+
+    Returns
+    -------
+    cols : ndarray.uint16; (..., N, K)
+    """
+    N = alist.shape[-2]
+    assert N <= np.iinfo(COMPACT_DTYPE).max + 1, f'N = {N} too large for uint16'
+    assert alist.min() >= 0, 'compact lists need fixed K, no -1 entries'
+    return alist.astype(COMPACT_DTYPE)
+
+def tf_compact_to_alist(cols):
+    """ flattened-batch int32 neighbor lists from compact columns
+
+    Params
+    ------
+    cols : tensor.uint16; (b, N, K)
+        per-sample neighbor indices, eg fed from alist_to_compact or a
+        compact NeighborStore
+
+    Returns
+    -------
+    alist : tensor.int32; (b*N, K)
+        neighbor indices offset by N per sample
+    N : tensor.int32
+        number of particles per sample
+    """
+    shape = tf.shape(cols)
+    b, N, K = shape[0], shape[1], shape[2]
+    alist = tf.cast(cols, tf.int32) + tf.range(b)[:,None,None] * N
+    return tf.reshape(alist, [-1, K]), N
+
+def tf_compact_to_coo(cols):
+    """ COO_feats and diagonals from compact columns (self first),
+    see tf_alist_to_coo
+    """
+    return tf_alist_to_coo(*tf_compact_to_alist(cols))
+
+def tf_compact_to_adjacency(cols):
+    """ adj dict for shift_inv_15op_layer from compact columns,
+    see tf_alist_to_adjacency
+    """
+    return tf_alist_to_adjacency(*tf_compact_to_alist(cols))
@@ -0,0 +1,123 @@
+"""
+Precompute the neighbor lists of every sample in ZA datasets, on the ZA
+(displaced) particle positions, for graph models. Samples are split
+across processes, and the lists are written into one memory-mapped
+(samples, N, K) int32 array per dataset, read back by sample index with
+Dataset.open_graphs and Dataset.get_graph_batch.
+
+Each particle is its own first neighbor, as the ZA graph models expect.
+
+# 14 nearest neighbors in the periodic box, all datasets
+python make_graphs.py -k 14 --boxsize 128
+
+# neighbors within radius 6, at most 32 (-1 padded), dataset 0, 8 processes
+python make_graphs.py -d 0 -k 32 -r 6 -w 8
+
+# approximate neighbors, faster at large N; recall on test samples is reported
+python make_graphs.py -k 14 --boxsize 128 --eps 0.5
+
+# compact uint16 lists (fixed K only), half the size, for graph.tf_compact_to_coo
+python make_graphs.py -k 14 --boxsize 128 --compact
+"""
+import os
+import argparse
+import multiprocessing
+import numpy as np
+
+import utils
+import graph
+from utils import Dataset, ZA_LABELS
+
+cli = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawTextHelpFormatter)
+cli.add_argument('-d', '--data_idxs', type=int, nargs='+',
+                 default=list(range(len(utils.ZA_PATHS))), metavar='i',
+                 help='Indices of datasets to process; default all')
+cli.add_argument('-k', '--kneighbors', type=int, default=utils.NUM_NEIGHBORS,
+                 metavar='K', help='Number of neighbors (max, if radius)')
+cli.add_argument('-r', '--radius', type=float, default=None, metavar='R',
+                 help='Only neighbors within radius R')
+cli.add_argument('--boxsize', type=float, default=None,
+                 help='Periodic box side, eg 128; default non-periodic')
+cli.add_argument('--eps', type=float, default=0,
+                 help='Approximate search tolerance, eg 0.5; recall is measured')
+cli.add_argument('-t', '--num_test', type=int, default=utils.num_test_samples,
+                 metavar='M', help='Test split size of the training runs, for recall')
+cli.add_argument('--compact', action='store_true',
+                 help='Write uint16 lists; not with radius (needs N <= 2**16)')
+cli.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                 metavar='W', help='Number of processes')
+
+def write_chunk(task):
+    """ compute the neighbor lists of samples [i, j) into the output file """
+    data_idx, path, i, j, K, boxsize, radius, eps = task
+    data = np.load(Dataset.data_paths[data_idx], mmap_mode='r')
+    out = np.load(path, mmap_mode='r+')
+    for s in range(i, j):
+        pos = Dataset.grid + Dataset.process_data(data[s])[:,:3] # ZA positions
+        out[s] = graph.get_kneighbors(pos, K, boxsize, include_self=True,
+                                      radius=radius, workers=1, eps=eps)
+    out.flush()
+    return j - i
+
+def write_graphs(data_idx, K, boxsize=None, radius=None, eps=0, num_workers=1,
+                 compact=False, num_test=utils.num_test_samples):
+    """ compute and write the neighbor lists of every sample in a dataset
+
+    If approximate (eps > 0), recall against exact neighbors is measured
+    on a few test samples (of a num_test split), and kept in the meta
+
+    If compact, the lists are written as uint16 (graph.alist_to_compact)
+    """
+    assert not (compact and radius is not None), 'compact lists need fixed K'
+    dtype = graph.COMPACT_DTYPE if compact else np.int32
+    path = Dataset.get_graph_path(data_idx, K, boxsize, radius, eps, compact)
+    utils.mkpath(os.path.dirname(path))
+    if os.path.exists(path + '.yml'):
+        os.remove(path + '.yml') # invalidate before overwriting data
+    n = np.load(Dataset.data_paths[data_idx], mmap_mode='r').shape[0]
+    tmp = f'{path}.tmp{os.getpid()}.npy'
+    np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype,
+                              shape=(n, Dataset.num_particles, K))
+
+    # small chunks, so work stays balanced across processes
+    step = max(1, n // (4 * num_workers))
+    tasks = [(data_idx, tmp, i, min(i + step, n), K, boxsize, radius, eps)
+             for i in range(0, n, step)]
+    with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+        done = 0
+        for count in pool.imap_unordered(write_chunk, tasks):
+            done += count
+            print(f'\r\t{done}/{n} samples', end='', flush=True)
+    os.replace(tmp, path + '.npy')
+    meta = dict(source=Dataset.get_cache_meta(data_idx), K=K, boxsize=boxsize,
+                radius=radius, eps=eps, compact=compact)
+    if eps:
+        meta['recall'] = float(measure_recall(data_idx, path + '.npy', K, boxsize,
+                                              radius, num_test))
+    utils.W_yml(path + '.yml', meta)
+    print("\nWrote neighbor lists to:\n\t" + path + '.npy\n')
+
+def measure_recall(data_idx, path, K, boxsize=None, radius=None,
+                   num_test=utils.num_test_samples, num_samples=4):
+    """ recall of written neighbor lists against exact, on test samples """
+    data = np.load(Dataset.data_paths[data_idx], mmap_mode='r')
+    alist = np.load(path, mmap_mode='r')
+    test_idx = np.sort(Dataset.split_dataset(len(data), num_test)[-1][:num_samples])
+    exact = [graph.get_kneighbors(Dataset.grid + Dataset.process_data(data[s])[:,:3],
+                                  K, boxsize, include_self=True, radius=radius)
+             for s in test_idx]
+    recall = graph.get_recall(alist[test_idx], np.stack(exact), include_self=True)
+    print(f'\n\trecall {recall:.4f} on test samples {test_idx.tolist()}')
+    return recall
+
+def main():
+    args = cli.parse_args()
+    for i in args.data_idxs:
+        print(f'Processing ZA_{ZA_LABELS[i]}')
+        write_graphs(i, args.kneighbors, args.boxsize, args.radius, args.eps,
+                     args.workers, args.compact, args.num_test)
+    return 0
+
+if __name__ == '__main__':
+    main()
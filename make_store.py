@@ -0,0 +1,39 @@
+"""
+Convert ZA datasets into chunked sample stores, for fast per-sample
+random access during training (see utils.SampleStore).
+
+# convert all datasets, lossless
+python make_store.py
+
+# datasets 0 and 3, at half precision, more compression
+python make_store.py -d 0 3 --half -z 6
+"""
+import argparse
+import numpy as np
+
+import utils
+from utils import Dataset, ZA_LABELS
+
+cli = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawTextHelpFormatter)
+cli.add_argument('-d', '--data_idxs', type=int, nargs='+',
+                 default=list(range(len(utils.ZA_PATHS))), metavar='i',
+                 help='Indices of datasets to convert; default all')
+cli.add_argument('-z', '--level', type=int, default=1, choices=range(10),
+                 metavar='Z', help='zlib compression level, 0 for none')
+cli.add_argument('--half', action='store_true',
+                 help='Store samples as float16 (lossy)')
+cli.add_argument('--no_shuffle', action='store_true',
+                 help='Do not byte-shuffle values before compressing')
+
+def main():
+    args = cli.parse_args()
+    dtype = np.float16 if args.half else np.float32
+    for i in args.data_idxs:
+        print(f'Converting ZA_{ZA_LABELS[i]}')
+        Dataset.write_store(i, dtype=dtype, level=args.level,
+                            shuffle=not args.no_shuffle)
+    return 0
+
+if __name__ == '__main__':
+    main()
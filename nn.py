@@ -2,6 +2,7 @@ import code, sys
 import numpy as np
 import tensorflow as tf
 import utils
+import graph
 
 #-----------------------------------------------------------------------------#
 #                                  set model                                  #
@@ -97,6 +98,51 @@ def model_func_set(X_in, model_vars):
     return X_out
 
 
+#-----------------------------------------------------------------------------#
+#                              in-graph kneighbors                            #
+#-----------------------------------------------------------------------------#
+
+def model_func_tf_graph(X_in, model_vars, K, boxsize=128.):
+    """ shift-invariant graph model, with the kneighbor graph of the ZA
+    positions built in-graph, so positions ---> adjacency ---> prediction
+    (---> loss) is one session call, with no graph fed from the host
+
+    Params
+    ------
+    X_in : tf.tensor(float32); (b, N, 6)
+        za input data, where X_in[...,:3] is init pos, X_in[...,3:] is displacement
+
+    model_vars : utils.ModelVars
+        model config and variable utils; layers take 3 input channels
+        (edge features), eg channels [3, 32, ..., 3]
+
+    K : int
+        number of neighbors, self included
+
+    Returns
+    -------
+    pred_error : tf.tensor(float32); (b, N, 3)
+    """
+    num_layers = model_vars.num_layers
+    activation = model_vars.activation
+    get_layer_vars = model_vars.get_layer_vars
+    init_pos, za_disp = X_in[...,:3], X_in[...,3:]
+    dims = (tf.shape(X_in)[0], X_in.shape[1].value) # (b, N)
+
+    #=== graph inputs
+    alist = graph.tf_periodic_kneighbors(init_pos + za_disp, K, boxsize)
+    coo, diag = graph.tf_alist_to_coo(alist, dims[1])
+    H = graph.tf_edge_features_pbc_ZA(init_pos, za_disp, coo, diag, boxsize)
+
+    #=== layers
+    for layer_idx in range(num_layers):
+        is_last = layer_idx == num_layers - 1
+        H = graph.shift_inv_layer(H, coo, dims, get_layer_vars(layer_idx), is_last)
+        if not is_last:
+            H = activation(H)
+    return H
+
+
 
 
 
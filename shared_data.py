@@ -0,0 +1,38 @@
+"""
+Publish processed ZA datasets in host shared memory, so every training
+process on the host attaches to one copy instead of loading its own
+(see `python train.py --shared`).
+
+Segments stay in shared memory after this exits, until freed with --unlink.
+
+# publish dataset 0 (from its cache, if valid)
+python shared_data.py -d 0 --cache
+
+# free datasets 0 and 1
+python shared_data.py -d 0 1 --unlink
+"""
+import argparse
+
+from utils import Dataset
+
+cli = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawTextHelpFormatter)
+cli.add_argument('-d', '--data_idxs', type=int, nargs='+', default=[0],
+                 metavar='i', help='Indices of datasets to publish')
+cli.add_argument('--cache', action='store_true',
+                 help='Publish from processed dataset cache, if valid')
+cli.add_argument('--unlink', action='store_true',
+                 help='Free the datasets from shared memory instead')
+
+def main():
+    args = cli.parse_args()
+    for i in args.data_idxs:
+        if args.unlink:
+            Dataset.unlink_shared(i)
+        else:
+            shm, X = Dataset.attach_shared(i, cache=args.cache)
+            shm.close()
+    return 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Generate synthetic ZA/FastPM-like datasets, for benchmarking and smoke
+tests without the simulation data, and for scaling tests at larger grids.
+
+Files have the raw simulation layout that Dataset reads,
+(num_samples, G, G, G, 19), and are named like the real datasets
+(ZA_001.npy, ...), so pointing utils at them is enough:
+
+    NBODY_ZA_PATH=/path/to/out python train.py ...
+
+(Dataset itself assumes 32**3 particles; other grid sizes are for
+benchmarking loaders and graph builders directly.)
+
+Each sample is a Gaussian random field with power spectrum
+P(k) ~ k**n * exp(-(k/k_c)**2), from which the displacements are derived
+with FFTs:
+    ZA   : first-order (Zel'dovich) displacement, psi1 = -grad phi1
+    2LPT : psi1 + psi2, the second-order Lagrangian correction
+    FPM  : 2LPT, plus a cheap local nonlinear term, -nl * delta * psi1,
+           standing in for the extra infall of the full N-body solution
+Velocities are the displacements scaled by their growth rates (f = 1),
+and column 0 is left at zero. Samples are seeded individually, so output
+does not depend on the chunking.
+
+# 2 files of 1000 32**3 samples
+python synthetic.py -o ~/.Data/nbody_simulations/ZA_synthetic -f 2
+
+# 100 samples at 128**3, more nonlinear
+python synthetic.py -o /tmp/ZA_128 -g 128 -n 100 --sigma 1.0
+"""
+import os
+import time
+import argparse
+import numpy as np
+from scipy import fft
+
+import utils
+
+cli = argparse.ArgumentParser(description=__doc__,
+                              formatter_class=argparse.RawTextHelpFormatter)
+cli.add_argument('-o', '--out', type=str,
+                 default=utils.data_path + '/ZA_synthetic',
+                 help='Output directory for the generated datasets')
+cli.add_argument('-f', '--num_files', type=int, default=1, metavar='F',
+                 help='Number of datasets (files) to generate')
+cli.add_argument('-n', '--num_samples', type=int, default=utils.num_samples,
+                 metavar='n', help='Samples per dataset')
+cli.add_argument('-g', '--grid', type=int, default=32, metavar='G',
+                 help='Particles per side of the grid, G**3 per sample')
+cli.add_argument('-s', '--seed', type=int, default=utils.DATASET_SEED,
+                 help='Random seed; file i, sample j use [seed, i, j]')
+cli.add_argument('--sigma', type=float, default=0.5,
+                 help='rms ZA displacement per axis, in particle spacings')
+cli.add_argument('--spectral_index', type=float, default=-2.0, metavar='n',
+                 help='Power-law index of the field power spectrum')
+cli.add_argument('--nl', type=float, default=0.1,
+                 help='Strength of the nonlinear FPM term')
+cli.add_argument('--chunk_mb', type=int, default=512, metavar='MB',
+                 help='Approximate memory per chunk of generated samples')
+cli.add_argument('--overwrite', action='store_true',
+                 help='Replace existing files in the output directory')
+
+SPACING = 4 # particle spacing in position units, see utils.get_grid_pos
+NUM_COLUMNS = 19
+
+
+#-----------------------------------------------------------------------------#
+#                                  Generator                                  #
+#-----------------------------------------------------------------------------#
+
+class FieldGenerator:
+    """ vectorized generator of displacement fields on a G**3 grid
+
+    All spectral factors are computed once per grid; generating a chunk
+    of samples is then only elementwise work and batched single-precision
+    FFTs over the chunk.
+
+    Params
+    ------
+    side : int
+        particles per side of the grid, G
+
+    sigma : float
+        rms ZA displacement per axis, in particle spacings
+
+    spectral_index : float
+        power-law index n of P(k) ~ k**n * exp(-(k/k_c)**2), with the
+        cutoff k_c at half the grid Nyquist frequency
+
+    nl : float
+        strength of the nonlinear FPM term
+    """
+    def __init__(self, side=32, sigma=0.5, spectral_index=-2.0, nl=0.1):
+        self.side = side
+        self.nl = nl
+        G = side
+        k_full = 2 * np.pi * fft.fftfreq(G, d=SPACING)
+        k_half = 2 * np.pi * fft.rfftfreq(G, d=SPACING)
+        kx, ky, kz = np.meshgrid(k_full, k_full, k_half, indexing='ij')
+        k2 = kx**2 + ky**2 + kz**2
+        k2[0, 0, 0] = 1 # no mean mode
+
+        # amplitude, normalized so rms psi1 per axis is sigma spacings
+        k_c = 0.5 * np.pi / SPACING
+        power = lambda k2: k2**(spectral_index / 2) * np.exp(-k2 / k_c**2)
+        kf2 = (k_full[:,None,None]**2 + k_full[None,:,None]**2
+               + k_full[None,None,:]**2)
+        kf2[0, 0, 0] = np.inf
+        var = np.mean(power(kf2) / kf2) / 3 # E[psi_x**2] for unit white noise
+        amp = np.sqrt(power(k2)) * (sigma * SPACING / np.sqrt(var))
+        amp[0, 0, 0] = 0
+
+        self.k = np.stack([kx, ky, kz]).astype(np.float32)    # (3, G, G, G//2+1)
+        self.amp = amp.astype(np.float32)                     # delta_k / noise_k
+        self.inv_k2 = (1 / k2).astype(np.float32)
+        self.inv_k2[0, 0, 0] = 0
+
+    def irfft(self, x_k):
+        return fft.irfftn(x_k, s=(self.side,)*3, axes=(-3, -2, -1), workers=-1)
+
+    def gradient(self, phi_k):
+        """ -grad phi; (..., 3) from (..., G, G, G//2+1) spectral potential """
+        return np.stack([self.irfft(-1j * k * phi_k) for k in self.k], axis=-1)
+
+    def generate(self, noise):
+        """ displacements and velocities for a chunk of white-noise fields
+
+        Params
+        ------
+        noise : ndarray.float32; (b, G, G, G)
+            unit white noise, one field per sample
+
+        Returns
+        -------
+        out : ndarray.float32; (b, G, G, G, 19)
+            raw simulation layout, see utils ZA Data Features
+        """
+        delta_k = fft.rfftn(noise, axes=(-3, -2, -1), workers=-1) * self.amp
+        phi1_k = -delta_k * self.inv_k2 # laplacian phi1 = delta
+        psi1 = self.gradient(phi1_k)    # delta = -div psi1
+
+        # 2LPT: laplacian phi2 = sum_{i<j} phi_ii phi_jj - phi_ij**2
+        kx, ky, kz = self.k
+        d = lambda ki, kj: self.irfft(-ki * kj * phi1_k) # phi1_ij
+        xx, yy, zz = d(kx, kx), d(ky, ky), d(kz, kz)
+        src = xx*yy + xx*zz + yy*zz
+        for ki, kj in [(kx, ky), (kx, kz), (ky, kz)]:
+            src -= d(ki, kj)**2
+        phi2_k = -fft.rfftn(src, axes=(-3, -2, -1), workers=-1) * self.inv_k2
+        psi2 = (3 / 7) * self.gradient(phi2_k) # D2 = -3/7 D1**2
+
+        # FPM stand-in: extra infall where overdense, delta = phi1_ii
+        delta = (xx + yy + zz)[..., None]
+        psi_nl = -self.nl * np.clip(delta, -1, None) * psi1
+
+        out = np.zeros(noise.shape + (NUM_COLUMNS,), dtype=np.float32)
+        out[...,  1: 4] = psi1
+        out[...,  4: 7] = psi1 + psi2
+        out[...,  7:10] = psi1 + psi2 + psi_nl
+        out[..., 10:13] = psi1
+        out[..., 13:16] = psi1 + 2*psi2
+        out[..., 16:19] = psi1 + 2*psi2 + 2*psi_nl
+        return out
+
+
+def write_dataset(path, generator, num_samples, seed, chunk_size):
+    """ generate a dataset into a .npy file, one chunk of samples at a time
+
+    The file is memory-mapped and filled in place, and is only moved to
+    path once complete.
+    """
+    G = generator.side
+    tmp_path = path + '.tmp'
+    shape = (num_samples, G, G, G, NUM_COLUMNS)
+    X = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                  shape=shape)
+    noise = np.empty((chunk_size, G, G, G), dtype=np.float32)
+    for i in range(0, num_samples, chunk_size):
+        j = min(i + chunk_size, num_samples)
+        for s in range(i, j):
+            rng = np.random.RandomState(seed + [s])
+            noise[s - i] = rng.standard_normal((G, G, G))
+        X[i:j] = generator.generate(noise[:j - i])
+    X.flush()
+    del X
+    os.replace(tmp_path, path)
+
+
+def main():
+    args = cli.parse_args()
+    G = args.grid
+    generator = FieldGenerator(G, args.sigma, args.spectral_index, args.nl)
+    sample_mb = G**3 * NUM_COLUMNS * 4 * 3 / 2**20 # output + temporaries
+    chunk_size = int(max(1, min(args.num_samples, args.chunk_mb // sample_mb)))
+    os.makedirs(args.out, exist_ok=True)
+    for i in range(args.num_files):
+        path = f'{args.out}/ZA_{i+1:0>3}.npy'
+        if os.path.exists(path) and not args.overwrite:
+            print(f'Skipping existing {path}')
+            continue
+        t = time.time()
+        write_dataset(path, generator, args.num_samples, [args.seed, i],
+                      chunk_size)
+        gb = args.num_samples * G**3 * NUM_COLUMNS * 4 / 2**30
+        print(f'Generated {path}\n\t{gb:.2f} GB in {time.time() - t:.1f}s')
+    return 0
+
+if __name__ == '__main__':
+    main()
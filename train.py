@@ -6,7 +6,7 @@ import tensorflow as tf
 
 import nn
 import utils
-from utils import PARSER, Dataset, Saver
+from utils import PARSER, Dataset, Saver, BatchPrefetcher, EpochSampler
 
 
 #-----------------------------------------------------------------------------#
@@ -15,6 +15,16 @@ from utils import PARSER, Dataset, Saver
 
 # Parse args
 args = PARSER.parse_args()
+if args.data_idxs: # MultiDataset always streams from disk
+    for flag in ['shared', 'mmap']:
+        if getattr(args, flag):
+            PARSER.error(f'--{flag} is not supported with --data_idxs')
+if args.device_data: # batches are sampled in-graph, not by the host pipeline
+    if args.augment:
+        PARSER.error('--augment is not supported with --device_data')
+    for flag in ['prefetch', 'workers']:
+        if getattr(args, flag) != PARSER.get_default(flag):
+            PARSER.error(f'--{flag} has no effect with --device_data')
 
 # Training
 # ========
@@ -23,7 +33,7 @@ batch_size = args.batch_size
 data_idx   = args.data_idx
 num_test   = args.num_test
 model_name = args.name
-saver = Saver(data_idx, model_tag=model_name)
+saver = Saver(data_idx, model_tag=model_name, restore=args.restore)
 
 # train loop
 checkpoint = 250
@@ -33,12 +43,45 @@ save_checkpoint = lambda step: (step+1) % checkpoint == 0
 # ====
 num_test_batches = num_test // batch_size
 num_particles = 32**3
-dataset = Dataset(data_idx, num_test)
+if args.data_idxs:
+    dataset = utils.MultiDataset(args.data_idxs, num_test, cache=args.cache,
+                                 store=args.store, morton=args.morton)
+else:
+    dataset = Dataset(data_idx, num_test, mmap=args.mmap, cache=args.cache,
+                      store=args.store, shared=args.shared, morton=args.morton)
+sampler = EpochSampler(dataset.train_idx, batch_size, seed=args.seed)
+if args.restore: # else a previous run's sampler.yml is overwritten
+    saver.restore_sampler(sampler)
+start = sampler.position # batches already trained on, if resumed
+prefetch = args.prefetch > 0 and not args.device_data
+if args.augment: # augmented batches are new arrays anyway
+    get_minibatch = lambda: dataset.get_batch(next(sampler))
+    augment = lambda x: utils.augment_batch(x, perm=dataset.perm)
+    preprocessors = [augment, utils.split_batch]
+    release = lambda x_in: None
+else: # gather straight into preallocated input/target buffers
+    num_buffers = args.prefetch + args.workers + 1 if prefetch else 1
+    buffers = utils.BatchBuffers(batch_size, num_buffers, perm=dataset.perm)
+    get_minibatch = lambda: dataset.get_buffered_batch(next(sampler), buffers)
+    preprocessors = []
+    release = buffers.release # once a batch has been trained on
+if prefetch:
+    batches = BatchPrefetcher(get_minibatch, preprocessors,
+                              depth=args.prefetch, num_workers=args.workers)
+    next_batch = batches.get
+else:
+    def next_batch():
+        batch = get_minibatch()
+        for f in preprocessors:
+            batch = f(batch)
+        return batch
 
 # Model
 # =====
 lr = args.learnrate
 channels = args.channels
+if args.tf_graph: # layers take the 3 edge features as input
+    channels = [3] + channels[1:]
 num_layers = len(channels) - 1
 params_seed = args.seed
 var_scope = utils.VAR_SCOPE
@@ -58,12 +101,19 @@ utils.initialize_params(channels, vscope=var_scope, seed=params_seed)
 # Inputs
 # ======
 in_shape = (None, num_particles, 3)
-X_input = tf.placeholder(tf.float32, shape=in_shape[:-1] + (6,))
-true_error = tf.placeholder(tf.float32, shape=in_shape)
+if args.device_data: # sampled in-graph, but still feedable for evaluation
+    device_data = utils.DeviceData(dataset, batch_size, seed=args.seed)
+    X_input, true_error = device_data.x_za, device_data.x_fpm
+else:
+    X_input = tf.placeholder(tf.float32, shape=in_shape[:-1] + (6,))
+    true_error = tf.placeholder(tf.float32, shape=in_shape)
 
 # Outputs
 # =======
-pred_error = nn.model_func_set(X_input, model_vars)
+if args.tf_graph:
+    pred_error = nn.model_func_tf_graph(X_input, model_vars, args.kneighbors)
+else:
+    pred_error = nn.model_func_set(X_input, model_vars)
 
 # Optimizer and loss
 # ==================
@@ -75,6 +125,8 @@ train = optimizer.minimize(error)
 sess = utils.initialize_session()
 utils.initialize_graph(sess)
 saver.init_sess_saver()
+if args.device_data:
+    device_data.initialize(sess)
 
 #=============================================================================#
 #                                    Training                                 #
@@ -87,41 +139,50 @@ print(f'\nTraining:\n{"="*78}')
 for step in range(num_iters):
     # Data batching
     # ----------------
-    _x_batch = dataset.get_minibatch() # (2, 4, N, 6)
-
-    # split data
-    #x_za  = _x_batch[0] # (b, N, 6)
-    #x_fpm = _x_batch[1] # (b, N, 6)
-    x_za = _x_batch[...,:6]
-    x_fpm = _x_batch[...,6:]
-
-    # displacements
-    #x_za_disp  = x_za[...,:3]
-    #x_fpm_disp = x_fpm[...,:3]
-
-    # get initial positions
-    #init_pos = nn.get_init_pos(x_za_disp)
-
-    # calculate true_error
-    #true_err = x_fpm_disp - x_za_disp
-
-    # Feed data and Train
-    #code.interact(local=dict(globals(), **locals()))
-    fdict = {
-        X_input : x_za,
-        true_error : x_fpm, #true_err,
-    }
-    train.run(feed_dict=fdict)
+    if args.device_data: # batch sampled in-graph, nothing to feed
+        train.run()
+        fdict = {}
+    else:
+        # split data
+        #x_za  = _x_batch[0] # (b, N, 6)
+        #x_fpm = _x_batch[1] # (b, N, 6)
+        x_za, x_fpm = next_batch() # (b, N, 6), (b, N, 3)
+
+        # displacements
+        #x_za_disp  = x_za[...,:3]
+        #x_fpm_disp = x_fpm[...,:3]
+
+        # get initial positions
+        #init_pos = nn.get_init_pos(x_za_disp)
+
+        # calculate true_error
+        #true_err = x_fpm_disp - x_za_disp
+
+        # Feed data and Train
+        #code.interact(local=dict(globals(), **locals()))
+        fdict = {
+            X_input : x_za,
+            true_error : x_fpm, #true_err,
+        }
+        train.run(feed_dict=fdict)
 
     # Save
     if save_checkpoint(step):
         err, pred_err = sess.run([error, pred_error], feed_dict=fdict)
         saver.save_model(step, sess)
+        if not args.device_data: # in-graph sampling does not use the sampler
+            saver.save_sampler(sampler, position=start + step + 1)
         saver.print_checkpoint(step, err)
+        if prefetch:
+            batches.print_wait_stats()
+    if not args.device_data:
+        release(x_za)
 
 tfin = time.time()
 est_time = (tfin - tstart) / 60  # minutes
 print(f"Training finished!\n\tElapsed time: {est_time:.2f}m")
+if prefetch:
+    batches.close()
 # Save trained variables and session
 saver.save_model(num_iters, sess, write_meta=True)
 
@@ -136,19 +197,17 @@ test_predictions = np.zeros((2, num_test, num_particles, channels[-1]), dtype=np
 #=============================================================================#
 
 print(f'\nEvaluation:\n{"="*78}')
-X_test = dataset.X_test
+test_idx = dataset.test_idx
+test_buffers = utils.BatchBuffers(batch_size, perm=dataset.perm)
 for j in range(num_test_batches): # ---> range(50) for b = 4
     # Validation cubes
     # ----------------
     p, q = batch_size*j, batch_size*(j+1)
     #_x_batch = X_test[:, p:q]
-    _x_batch = X_test[p:q]
-
     # split data
     #x_za  = _x_batch[0] # (b, N, 6)
     #x_fpm = _x_batch[1] # (b, N, 6)
-    x_za = _x_batch[...,:6]
-    x_fpm = _x_batch[...,6:]
+    x_za, x_fpm = dataset.get_buffered_batch(test_idx[p:q], test_buffers)
 
 
     # displacements
@@ -171,13 +230,14 @@ for j in range(num_test_batches): # ---> range(50) for b = 4
     test_predictions[0, p:q] = x_fpm
     test_predictions[1, p:q] = p_error
     test_error[j] = v_error
+    test_buffers.release(x_za)
     print(f'val_err, {j} : {v_error}')
 
 
 
 # END Validation
 # ========================================
-saver.save_cube(test_predictions)
+saver.save_cube(test_predictions, inv_perm=dataset.inv_perm)
 saver.save_error(test_error)
 saver.print_evaluation_results(test_error)
 
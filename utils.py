@@ -27,17 +27,31 @@ Dataset
 Manages the loading and processing of datasets from disk, and also
 provides the batching interface to the dataset during training.
 
+BatchPrefetcher
+===============
+Prepares batches (and any per-batch preprocessing) ahead of the
+training step in background workers.
+
 """
 import os
 import sys
 import glob
 import code
 import time
+import queue
 import random
 import argparse
 import datetime
+import itertools
+import threading
+import multiprocessing
 from functools import wraps
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import zlib
+import hashlib
+from multiprocessing import shared_memory, resource_tracker
 
 import yaml
 import numpy as np
@@ -73,7 +87,7 @@ def TODO(f):
 # -------------
 def R_yml(fname):
     with open(fname) as file:
-        return yaml.load(file)
+        return yaml.safe_load(file)
 
 def W_yml(fname, obj):
     with open(fname, 'w') as file:
@@ -101,7 +115,7 @@ RESULTS_DIR = EXPERIMENTS_DIR + '/{}' + '/Results'
 
 # Dataset
 # =======
-ZA_path = data_path + '/ZA'
+ZA_path = os.environ.get('NBODY_ZA_PATH', data_path + '/ZA') # eg synthetic data, see synthetic.py
 ZA_PATHS = ZA_datasets = sorted(glob.glob(ZA_path + '/*.npy')) # 10 total ZA datasets
 # example paths:
 #  ['/home/evan/.Data/nbody_simulations/ZA/ZA_001.npy',
@@ -152,6 +166,29 @@ DATASET_SEED  = 12345
 ZA_DEFAULT_IDX = 0
 za_default = ZA_LABELS[ZA_DEFAULT_IDX] # '001'
 
+# preprocessed dataset cache
+# ==========================
+# Bump PREPROCESS_VERSION whenever Dataset processing or splitting changes;
+# caches written under another version are rebuilt.
+PREPROCESS_VERSION = 3
+CACHE_DIR = '{}_cache' # eg '/path/to/data/ZA_001_cache'
+
+# chunked sample store, one (compressed) chunk per processed sample
+STORE_DIR = '{}_store' # eg '/path/to/data/ZA_001_store'
+
+# per-sample neighbor lists, see make_graphs.py
+GRAPH_DIR = '{}_graphs' # eg '/path/to/data/ZA_001_graphs'
+
+# shared-memory datasets, published once per host
+SHM_NAME = 'nbody_ZA_{}_{}' # eg 'nbody_ZA_001_3f2a9c1e'
+SHM_HEADER = 64 # bytes before data; int64 ready flag (1 once data is ready), publisher pid
+
+# multi-simulation streaming
+SAMPLE_CACHE_SIZE = 512 # decoded samples held in memory, ~0.8 MB each
+
+# static graphs, eg the Lagrangian grid kneighbor adjacency (see graph.py)
+GRAPH_CACHE_DIR = data_path + '/graph_cache'
+
 
 #-----------------------------------------------------------------------------#
 #                               MODEL SETTINGS                                #
@@ -255,6 +292,10 @@ adg('-d', '--data_idx', type=int, default=0,
     choices=set(range(len(ZA_LABELS))), metavar='i',
     help='Index, int in [0, 10), corresponding to a dataset; eg 0: ')
 
+adg('-D', '--data_idxs', type=int, nargs='+', default=None,
+    choices=set(range(len(ZA_LABELS))), metavar='i',
+    help='Train on several datasets at once, streamed from disk; eg -D 0 1 2')
+
 adg('-k', '--kneighbors', type=int, default=NUM_NEIGHBORS, metavar='K',
     help='Number of neighbors in graph model (KNN); if K == -1, then set model')
 
@@ -270,10 +311,38 @@ adg('-l', '--learnrate', type=float, default=0.01, metavar='lr',
 adg('-t', '--num_test', type=int, default=num_test_samples, metavar='M',
     help='Number of samples in test set')
 
+adg('--mmap', action='store_true',
+    help='Memory-map dataset; samples are read from disk as they are batched')
+
+adg('--cache', action='store_true',
+    help='Load processed dataset splits from on-disk cache (built if stale)')
+
+adg('--store', action='store_true',
+    help='Read samples from chunked sample store (see make_store.py)')
 
-# NOT YET SUPPORTED
-#adg('-r', '--restore', action='store_true',
-#    help='Restore pretrained model parameters')
+adg('--shared', action='store_true',
+    help='Attach to dataset in shared memory (published if not yet there)')
+
+adg('--prefetch', type=int, default=4, metavar='K',
+    help='Number of batches prepared ahead in background; 0 disables')
+
+adg('--workers', type=int, default=2, metavar='W',
+    help='Number of background batch prefetching workers')
+
+adg('--device_data', action='store_true',
+    help='Keep training split on device and sample minibatches in-graph\n(not with --augment, --prefetch, --workers)')
+
+adg('--augment', action='store_true',
+    help='Randomly rotate/flip and periodically translate training cubes')
+
+adg('--morton', action='store_true',
+    help='Order particles along a Morton (Z-order) curve in batches')
+
+adg('--tf_graph', action='store_true',
+    help='Graph model on kneighbors of ZA positions, built in-graph')
+
+adg('-r', '--restore', action='store_true',
+    help='Resume run -n: restore its latest checkpoint and sampler position')
 
 
 
@@ -478,22 +547,47 @@ class Saver:
         if self.restore:
             self.restore_model_parameters()
 
-    def restore_model_parameters(self):
-        raise NotImplementedError('TODO')
+    def restore_model_parameters(self, sess=None):
+        """ restore the latest checkpoint in params into sess (default session) """
+        chkpt = tf.train.latest_checkpoint(self.params)
+        if chkpt is None:
+            raise FileNotFoundError(f'No model checkpoint to restore in {self.params}')
+        self.saver.restore(sess or tf.get_default_session(), chkpt)
+        print("\nRestored model parameters from:\n\t" + chkpt + '\n')
 
     def save_model(self, cur_iter, sess, write_meta=False):
         self.saver.save(sess, self.params + '/chkpt',
             global_step=cur_iter+1, write_meta_graph=write_meta)
 
+    def save_sampler(self, sampler, position=None):
+        """ save EpochSampler state alongside the model checkpoint
+        position : number of batches actually consumed by training, if the
+            sampler has run ahead of training (eg, with a BatchPrefetcher)
+        """
+        W_yml(self.params + '/sampler.yml', sampler.state_dict(position))
+
+    def restore_sampler(self, sampler):
+        """ restore EpochSampler state, if one was saved; only meaningful
+        along with the model parameters (restore)
+        """
+        spath = self.params + '/sampler.yml'
+        if os.path.exists(spath):
+            sampler.load_state_dict(R_yml(spath))
+
     def save_error(self, error, training=False):
         suffix = 'training' if training else 'test'
         dst = self.results + f'/error_{suffix}'
         np.save(dst, error)
         print(f"\n\tSaved model {suffix} error: \n\t\t{dst}\n")
 
-    def save_cube(self, cube, ground_truth=False):
+    def save_cube(self, cube, ground_truth=False, inv_perm=None):
+        """ inv_perm : restores original particle order, if cube particles
+                (axis -2) were permuted, eg Dataset(morton=True).inv_perm
+        """
         suffix = 'truth' if ground_truth else 'prediction'
         dst = f'{self.results}/{self.cube}_{suffix}'
+        if inv_perm is not None:
+            cube = cube[..., inv_perm, :]
         np.save(dst, cube)
         print(f"\n\tSaved {suffix} cube: \n\t\t{dst}\n")
 
@@ -542,27 +636,279 @@ X[..., 7:10] : FastPM displacements
 X[...,10:13] : ZA velocity
 X[...,13:16] : 2LPT velocity
 X[...,16:19] : FastPM velocity
+
+## Processed samples
+Dataset stores only the per-sample displacement channels,
+    X[..., :3] : ZA displacement
+    X[..., 3:] : FastPM displacement - ZA displacement
+and the Lagrangian grid positions, which are identical for every sample,
+are kept once in `Dataset.grid` and only joined in when batches are
+assembled: batch[..., :3] = grid, batch[..., 3:6] = ZA, batch[..., 6:] = FPM - ZA
 """
 
+def get_grid_pos(side=32):
+    """ fixed Lagrangian grid positions, centered on the box; (side**3, 3)
+
+    Particles are spaced 4 units apart, so the box is 4*side across
+    """
+    mg = range(2, 4*side + 2, 4)
+    q = np.einsum('ijkl->kjli', np.array(np.meshgrid(mg, mg, mg)))
+    return (q.reshape(-1, 3) - 2*side).astype(np.float32)
+
+
+class MemmapSamples:
+    """ lazy, sample-indexed view over a memory-mapped ZA dataset
+
+    Only the displacement columns needed by the model are read from disk,
+    one sample at a time, whenever samples are indexed. Indexing on the
+    sample axis returns processed (grid-free) ndarray samples, exactly as
+    `Dataset.load_data` would have produced them.
+
+    Params
+    ------
+    data : np.memmap; (1000, 32, 32, 32, 19)
+        raw simulation data, opened with mmap_mode='r'
+
+    idx : ndarray.int; (n,)
+        the sample indices in data that this view exposes
+    """
+    def __init__(self, data, idx=None):
+        self.data = data
+        self.idx = np.arange(data.shape[0]) if idx is None else np.asarray(idx)
+
+    @property
+    def shape(self):
+        return (len(self.idx), Dataset.num_particles, 6)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, key):
+        # split sample-axis key from the rest (applied to processed samples)
+        rest = None
+        if isinstance(key, tuple):
+            if key[0] is Ellipsis:
+                key, rest = slice(None), key
+            else:
+                key, rest = key[0], key[1:]
+        single = np.ndim(key) == 0 and not isinstance(key, slice)
+        sample_idx = np.atleast_1d(self.idx[key])
+
+        # read sorted for locality, then restore requested order
+        order = np.argsort(sample_idx, kind='stable')
+        X = np.empty((len(sample_idx),) + self.shape[1:], dtype=np.float32)
+        for i in order:
+            X[i] = Dataset.process_data(self.data[sample_idx[i]])
+        if single:
+            X = X[0]
+        return X if rest is None else X[rest]
+
+
+class SampleStore:
+    """ reader for a chunked on-disk sample store, see Dataset.write_store
+
+    The store holds each processed sample as its own chunk in 'data.bin',
+    optionally at reduced precision, byte-shuffled and zlib compressed,
+    with chunk (offset, size) in 'index.npy'. Any sample can be read on its
+    own, with a single pread, from any thread or forked process.
+
+    Params
+    ------
+    sdir : str
+        path to store dir
+    """
+    def __init__(self, sdir):
+        self.sdir = sdir
+        self.meta = R_yml(sdir + '/meta.yml')
+        self.index = np.load(sdir + '/index.npy') # (n, 2), chunk offset, nbytes
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.fd = os.open(sdir + '/data.bin', os.O_RDONLY)
+
+    @property
+    def shape(self):
+        return (len(self.index), Dataset.num_particles, 6)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    @staticmethod
+    def encode(x, dtype, level, shuffle):
+        buf = np.ascontiguousarray(x, dtype=dtype)
+        buf = np.frombuffer(buf.tobytes(), dtype=np.uint8)
+        if shuffle: # group the i-th byte of every value, so zlib sees runs
+            buf = buf.reshape(-1, np.dtype(dtype).itemsize).T
+        buf = buf.tobytes()
+        return zlib.compress(buf, level) if level > 0 else buf
+
+    def decode(self, buf):
+        if self.meta['level'] > 0:
+            buf = zlib.decompress(buf)
+        x = np.frombuffer(buf, dtype=np.uint8)
+        if self.meta['shuffle']:
+            x = x.reshape(self.dtype.itemsize, -1).T.copy()
+        x = x.view(self.dtype).reshape(self.shape[1:])
+        return x.astype(np.float32)
+
+    def __getitem__(self, key):
+        if np.ndim(key) > 0 or isinstance(key, slice):
+            idx = np.arange(len(self))[key]
+            return np.array([self[j] for j in idx], dtype=np.float32)
+        offset, nbytes = self.index[key]
+        return self.decode(os.pread(self.fd, int(nbytes), int(offset)))
+
+
+class NeighborStore:
+    """ reader for precomputed per-sample neighbor lists, see make_graphs.py
+
+    The lists of all samples are one memory-mapped (n, N, K) int32 array,
+    or uint16 if compact (see graph.alist_to_compact), so only the
+    requested samples are ever read, and are returned in the stored dtype.
+    If the batches are in a different particle order (perm), the lists
+    are reordered and reindexed to match.
+
+    Params
+    ------
+    path : str
+        path to the neighbor lists .npy
+    perm : ndarray.int; (N,)
+        particle order of the batches, eg Dataset.perm; grid order if None
+    """
+    def __init__(self, path, perm=None):
+        self.path = path
+        self.alist = np.load(path, mmap_mode='r') # (n, N, K)
+        self.perm = perm
+        self.inv_perm = None
+        if perm is not None:
+            self.inv_perm = np.argsort(perm).astype(self.alist.dtype)
+
+    @property
+    def shape(self):
+        return self.alist.shape
+
+    def __len__(self):
+        return len(self.alist)
+
+    def __getitem__(self, key):
+        """ neighbor lists of samples key; -1 where there is no neighbor """
+        alist = np.array(self.alist[key])
+        if self.perm is not None:
+            alist = alist[..., self.perm, :]
+            alist = np.where(alist < 0, alist, self.inv_perm[alist])
+        return alist
+
+
+def pid_alive(pid):
+    """ whether process pid (on this host) is still running """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # exists, owned by another user
+        return True
+    return True
+
+
 class Dataset:
-    """ Manages dataset and loading, processing, batching """
+    """ Manages dataset and loading, processing, batching
+
+    If mmap, the dataset file is memory-mapped instead of loaded, and
+    samples are only read (and processed) from disk when batched.
+
+    If cache, the processed dataset is loaded (memory-mapped) from a cache
+    dir next to the dataset file. The cache is rebuilt whenever the source
+    file or PREPROCESS_VERSION changes.
+
+    If store, samples are read from the dataset's chunked sample store,
+    written by Dataset.write_store (see make_store.py).
+
+    If shared, the processed dataset lives in host shared memory, where the
+    first process to ask for it publishes it; every other process attaches
+    to it read-only, with zero copies. See shared_data.py.
+
+    If morton, the particles of every batch are put in Morton (Z-curve)
+    order of their grid cells, so spatial neighbors are near each other in
+    memory. The order is `perm`, and `inv_perm` restores the original order
+    (eg, Saver.save_cube(cube, inv_perm=dataset.inv_perm)).
+
+    The processed dataset X is held once, grid-free, (n, N, 6); the
+    train/val/test splits are index arrays into X. Use `get_batch` or
+    `get_minibatch` to get model-ready (b, N, 9) batches with the grid
+    positions joined in.
+    """
     seed = DATASET_SEED # 12345
     data_paths = ZA_PATHS # ['/path/to/data/ZA_001.npy', '/path/to/data/ZA_002.npy',...]
     num_particles = NUM_PARTICLES # 32**3
     num_samples   = num_samples   # 1000
-    def __init__(self, data_idx=ZA_DEFAULT_IDX, num_test=num_test_samples):
+    grid = get_grid_pos() # (32**3, 3), shared by all samples
+    def __init__(self, data_idx=ZA_DEFAULT_IDX, num_test=num_test_samples,
+                 mmap=False, cache=False, store=False, shared=False, morton=False):
         self.data_idx = data_idx
         self.num_test = num_test
-        X = self.load_data(data_idx)
-        self.X_train, self.X_val, self.X_test = self.split_dataset(X, num_test)
+        self.mmap = mmap
+        self.set_particle_order(morton)
+        X = None
+        if shared:
+            self.shm, X = self.attach_shared(data_idx, cache=cache)
+        if X is None and store:
+            X = self.load_store(data_idx)
+        if X is None and cache:
+            X = self.load_cache(data_idx)
+        if X is None:
+            X = self.open_data(data_idx) if mmap and not cache else self.load_data(data_idx)
+            if cache:
+                self.write_cache(data_idx, X)
+        self.X = X
+        self.train_idx, self.val_idx, self.test_idx = self.split_dataset(len(X), num_test)
 
     def get_minibatch(self, batch_size=batch_size):
         """ randomly select training minibatch from dataset """
-        #N = self.X_train.shape[1]
-        N = self.X_train.shape[0]
-        batch_idx = np.random.choice(N, batch_size, replace=False)
-        #x = np.copy(self.X_train[:, batch_idx])
-        x = np.copy(self.X_train[batch_idx])
+        batch_idx = np.random.choice(self.train_idx, batch_size, replace=False)
+        return self.get_batch(batch_idx)
+
+    def set_particle_order(self, morton=False):
+        """ set perm, inv_perm; None if particles stay in grid order """
+        self.perm = MORTON_PERM if morton else None
+        self.inv_perm = MORTON_INV if morton else None
+
+    def get_batch(self, idx):
+        """ model-ready batch of samples idx, eg dataset.test_idx[p:q] """
+        return self.assemble_batch(self.X, idx, self.perm)
+
+    def get_buffered_batch(self, idx, buffers):
+        """ model input and target batches of samples idx, gathered into
+        the next slot of buffers (a BatchBuffers); see BatchBuffers.assemble
+        buffers must have been made with this dataset's perm
+        """
+        return buffers.assemble(self.X, idx)
+
+    @classmethod
+    def assemble_batch(cls, X, idx, perm=None):
+        """ gather samples from a grid-free split and join the grid positions
+
+        Params
+        ------
+        X : ndarray.float32; (n, N, 6) | MemmapSamples | SampleStore
+            grid-free samples, eg Dataset.X
+
+        idx : iterable(int)
+            sample indices into X
+
+        perm : ndarray.int; (N,)
+            particle order of the batch, eg MORTON_PERM; grid order if None
+
+        Returns
+        -------
+        x : ndarray.float32; (b, N, 9)
+            [grid pos, ZA displacement, FPM displacement - ZA displacement]
+        """
+        x = np.empty((len(idx), cls.num_particles, 9), dtype=np.float32)
+        x[..., :3] = cls.grid if perm is None else cls.grid[perm]
+        for i, j in enumerate(idx):
+            x[i, :, 3:] = X[j] if perm is None else X[j][perm]
         return x
 
 
@@ -572,54 +918,952 @@ class Dataset:
     #    pass
 
     @classmethod
-    def split_dataset(cls, X, num_test):
-        """ Splits dataset into train, validation, and test sets
+    def split_dataset(cls, num_samples, num_test):
+        """ Splits dataset indices into train, validation, and test sets
 
         Params
         ------
-        X : ndarray.float32; (2, 1000, 32**3, D)
-            ZA and FPM data
+        num_samples : int
+            number of samples in the dataset
 
         num_test : int
             number of samples in the test set
+
+        Returns
+        -------
+        train_idx, val_idx, test_idx : ndarray.int
+            sample indices of each split (no data is copied)
         """
         np.random.seed(cls.seed)
-        #rnd_idx = np.random.permutation(X.shape[1])
-        rnd_idx = np.random.permutation(X.shape[0])
+        rnd_idx = np.random.permutation(num_samples)
         split_idx = [-num_test - 100, -num_test] # could just go from front..
-        #return np.split(X[:, rnd_idx], split_idx, axis=1)
-        return np.split(X[rnd_idx], split_idx, axis=0)
+        return np.split(rnd_idx, split_idx)
 
     @classmethod
-    def load_data(cls, data_idx):
-        """ load dataset given data index which corresponds to the filename """
-        dpath = cls.data_paths[data_idx]
-        data = np.load(dpath) # (1000, 32, 32, 32, 19)
-        print("\nLoaded data from:\n\t" + dpath + '\n')
+    def process_data(cls, data):
+        """ process raw simulation samples into model data
+
+        Params
+        ------
+        data : ndarray.float32; (..., 32, 32, 32, 19)
+            one or more raw samples; only columns 1:4 and 7:10 are read
 
-        #=== Process data
-        reshape_dims = (cls.num_samples, cls.num_particles, 3)
+        Returns
+        -------
+        X : ndarray.float32; (..., 32**3, 6)
+            [ZA displacement, FPM displacement - ZA displacement]
+        """
+        reshape_dims = data.shape[:-4] + (cls.num_particles, 3)
         # data is reshaped like:
-        #     (1000, 32, 32, 32, 3) ---> (1, 1000, 32**3, 3)
+        #     (1000, 32, 32, 32, 3) ---> (1000, 32**3, 3)
 
         # displacements
         za  = data[...,1: 4].reshape(*reshape_dims)
         fpm = data[...,7:10].reshape(*reshape_dims)
         fpm = fpm - za # NOTE: THIS IS DIFF FROM PREVIOUS WAY (true_error)
 
-        # grid pos
-        mg = range(2, 130, 4)
-        q = np.einsum('ijkl->kjli', np.array(np.meshgrid(mg, mg, mg)))
-        q = np.broadcast_to(q.reshape(1, -1, 3), za.shape)#.reshape(*za.shape) # broadcast
+        # 'cat cubes; grid pos are NOT stored, see Dataset.grid
+        X = np.concatenate([za, fpm], axis=-1) # (1000, N, 6)
+        return X
 
-        za = np.concatenate([q-64, za], axis=-1) # (1000, N, 6)
+    @classmethod
+    def load_data(cls, data_idx, chunk_size=50, out=None):
+        """ load dataset given data index which corresponds to the filename
 
-        # 'cat cubes
-        #X = np.concatenate([za, fpm], axis=-1)
-        X = np.concatenate([za, fpm], axis=-1)
+        The raw file is memory-mapped and processed in chunks of samples
+        straight into the output array (out, if given), so only one
+        (processed) copy of the dataset is ever held in memory.
+        """
+        dpath = cls.data_paths[data_idx]
+        data = np.load(dpath, mmap_mode='r') # (1000, 32, 32, 32, 19)
+        n = data.shape[0]
+        X = np.empty((n, cls.num_particles, 6), dtype=np.float32) if out is None else out
+        for i in range(0, n, chunk_size):
+            X[i:i+chunk_size] = cls.process_data(data[i:i+chunk_size])
+        print("\nLoaded data from:\n\t" + dpath + '\n')
         #code.interact(local=dict(globals(), **locals()))
         return X
 
+    @classmethod
+    def open_data(cls, data_idx):
+        """ memory-map dataset given data index; nothing is read until batched """
+        dpath = cls.data_paths[data_idx]
+        data = np.load(dpath, mmap_mode='r') # (1000, 32, 32, 32, 19)
+        print("\nMemory-mapped data from:\n\t" + dpath + '\n')
+        return MemmapSamples(data)
+
+    # Preprocessed cache
+    # ==================
+    # Only the processed dataset is cached; the splits are cheap index
+    # permutations and are always rederived from Dataset.seed.
+    @classmethod
+    def get_cache_meta(cls, data_idx):
+        """ everything a cache must match to be valid for this dataset """
+        dpath = cls.data_paths[data_idx]
+        stat = os.stat(dpath)
+        meta = dict(source=os.path.abspath(dpath),
+                    source_mtime=stat.st_mtime_ns,
+                    source_size=stat.st_size,
+                    version=PREPROCESS_VERSION)
+        return meta
+
+    @classmethod
+    def load_cache(cls, data_idx):
+        """ memory-map cached dataset, or None if cache is missing or stale """
+        cdir = CACHE_DIR.format(os.path.splitext(cls.data_paths[data_idx])[0])
+        meta_path = cdir + '/meta.yml'
+        if not os.path.exists(meta_path):
+            return None
+        if R_yml(meta_path) != cls.get_cache_meta(data_idx):
+            print("\nStale dataset cache, rebuilding:\n\t" + cdir + '\n')
+            return None
+        X = np.load(cdir + '/X.npy', mmap_mode='r')
+        print("\nLoaded cached data from:\n\t" + cdir + '\n')
+        return X
+
+    @classmethod
+    def write_cache(cls, data_idx, X):
+        """ write processed dataset to cache dir
+
+        The data is written to a temporary name and then moved into place,
+        and meta.yml is written last, so concurrent runs never see a
+        partially written cache as valid.
+        """
+        cdir = CACHE_DIR.format(os.path.splitext(cls.data_paths[data_idx])[0])
+        mkpath(cdir)
+        meta_path = cdir + '/meta.yml'
+        if os.path.exists(meta_path):
+            os.remove(meta_path) # invalidate before overwriting data
+        tmp = f'.tmp{os.getpid()}'
+        np.save(f'{cdir}/X{tmp}.npy', X)
+        os.replace(f'{cdir}/X{tmp}.npy', cdir + '/X.npy')
+        W_yml(meta_path + tmp, cls.get_cache_meta(data_idx))
+        os.replace(meta_path + tmp, meta_path)
+        print("\nWrote dataset cache to:\n\t" + cdir + '\n')
+
+    # Shared memory
+    # =============
+    @classmethod
+    def get_shared_name(cls, data_idx):
+        """ shm name, unique to the dataset's source file and preprocessing """
+        meta = cls.get_cache_meta(data_idx)
+        tag = hashlib.md5(str(sorted(meta.items())).encode()).hexdigest()[:8]
+        return SHM_NAME.format(ZA_LABELS[data_idx], tag)
+
+    @classmethod
+    def attach_shared(cls, data_idx, cache=False, timeout=1800):
+        """ attach to processed dataset in shared memory, publishing it first
+        if no other process has
+
+        The segment outlives the process, so later runs attach to it
+        instantly, until it is freed with Dataset.unlink_shared. If
+        publishing fails the segment is unlinked, and if the publisher
+        died mid-load (its pid is in the header), an attacher frees the
+        stale segment and publishes instead.
+
+        Returns
+        -------
+        shm : shared_memory.SharedMemory
+            keep a reference for as long as X is used
+
+        X : ndarray.float32; (n, N, 6)
+            read-only view of the processed dataset in shm
+        """
+        name = cls.get_shared_name(data_idx)
+        n = np.load(cls.data_paths[data_idx], mmap_mode='r').shape[0]
+        shape = (n, cls.num_particles, 6)
+        size = SHM_HEADER + int(np.prod(shape)) * 4
+        t = time.time()
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(name, create=True, size=size)
+                publish = True
+                break
+            except FileExistsError:
+                pass
+            try:
+                shm = shared_memory.SharedMemory(name)
+                publish = False
+                if shm.size >= size:
+                    break
+                resource_tracker.unregister(shm._name, 'shared_memory')
+                shm.close()
+            except (ValueError, FileNotFoundError):
+                pass # publisher is between shm_open and ftruncate, or just unlinked
+            if time.time() - t > timeout:
+                raise TimeoutError(f'shared dataset {name} could not be attached')
+            time.sleep(0.05)
+        # the resource tracker would unlink the segment when this process exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        header = np.ndarray((2,), dtype=np.int64, buffer=shm.buf) # ready, pid
+        X = np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=SHM_HEADER)
+
+        if publish:
+            header[1] = os.getpid()
+            try:
+                cached = cls.load_cache(data_idx) if cache else None
+                if cached is None:
+                    cls.load_data(data_idx, out=X)
+                else:
+                    X[:] = cached
+            except BaseException: # don't leave a never-ready segment behind
+                del header, X
+                shm.close()
+                resource_tracker.register(shm._name, 'shared_memory') # unlink unregisters
+                shm.unlink()
+                raise
+            header[0] = 1
+            print("\nPublished data in shared memory:\n\t" + name + '\n')
+        else:
+            t = time.time()
+            while not header[0]: # another process is still publishing
+                pid = int(header[1])
+                if pid and not pid_alive(pid): # publisher died mid-load
+                    print(f"\nPublisher {pid} of shared data died, republishing:\n\t" + name + '\n')
+                    del header, X
+                    cls.unlink_stale_shared(shm, pid)
+                    return cls.attach_shared(data_idx, cache, timeout - (time.time() - t))
+                if time.time() - t > timeout:
+                    raise TimeoutError(f'shared dataset {name} never became ready')
+                time.sleep(0.5)
+            print("\nAttached to data in shared memory:\n\t" + name + '\n')
+        X.flags.writeable = False
+        return shm, X
+
+    @staticmethod
+    def unlink_stale_shared(shm, pid):
+        """ unlink a segment left unready by dead publisher pid, unless
+        another attacher already replaced it
+        """
+        name = shm.name
+        shm.close()
+        try:
+            current = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return
+        resource_tracker.unregister(current._name, 'shared_memory')
+        header = np.ndarray((2,), dtype=np.int64, buffer=current.buf)
+        stale = not header[0] and header[1] == pid
+        del header
+        current.close()
+        if stale:
+            resource_tracker.register(current._name, 'shared_memory')
+            current.unlink()
+
+    @classmethod
+    def unlink_shared(cls, data_idx):
+        """ free the dataset's shared memory segment, if published """
+        name = cls.get_shared_name(data_idx)
+        try:
+            shm = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+        print("\nFreed shared memory:\n\t" + name + '\n')
+
+    # Chunked sample store
+    # ====================
+    @classmethod
+    def load_store(cls, data_idx):
+        """ open dataset's sample store, or None if it is missing or stale """
+        sdir = STORE_DIR.format(os.path.splitext(cls.data_paths[data_idx])[0])
+        if not os.path.exists(sdir + '/meta.yml'):
+            print("\nNo sample store at:\n\t" + sdir + '\n')
+            return None
+        store = SampleStore(sdir)
+        if store.meta['source'] != cls.get_cache_meta(data_idx):
+            print("\nStale sample store, not used:\n\t" + sdir + '\n')
+            return None
+        print("\nOpened sample store:\n\t" + sdir + '\n')
+        return store
+
+    @classmethod
+    def write_store(cls, data_idx, dtype=np.float32, level=1, shuffle=True):
+        """ convert dataset to a chunked sample store, one chunk per sample
+
+        Params
+        ------
+        dtype : np.dtype
+            on-disk precision, eg np.float16 for half the size (lossy)
+
+        level : int
+            zlib compression level, 0 for uncompressed
+
+        shuffle : bool
+            byte-shuffle values before compressing (much better ratios
+            for float data)
+        """
+        dpath = cls.data_paths[data_idx]
+        sdir = STORE_DIR.format(os.path.splitext(dpath)[0])
+        mkpath(sdir)
+        meta_path = sdir + '/meta.yml'
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        data = np.load(dpath, mmap_mode='r') # (1000, 32, 32, 32, 19)
+        index = np.zeros((data.shape[0], 2), dtype=np.int64)
+        offset = 0
+        with open(sdir + '/data.bin', 'wb') as file:
+            for j in range(data.shape[0]):
+                buf = SampleStore.encode(cls.process_data(data[j]), dtype, level, shuffle)
+                file.write(buf)
+                index[j] = offset, len(buf)
+                offset += len(buf)
+        np.save(sdir + '/index.npy', index)
+        meta = dict(source=cls.get_cache_meta(data_idx), dtype=np.dtype(dtype).name,
+                    level=level, shuffle=shuffle)
+        W_yml(meta_path, meta)
+        ratio = offset / (index.shape[0] * cls.num_particles * 6 * 4)
+        print(f"\nWrote sample store to:\n\t{sdir}\n\t{offset / 2**20:.1f} MB, "
+              f"{ratio:.2f}x of float32\n")
+
+    # Neighbor graphs
+    # ===============
+    # Per-sample neighbor lists on the ZA positions, written by make_graphs.py
+    @classmethod
+    def get_graph_path(cls, data_idx, K, boxsize=None, radius=None, eps=0,
+                       compact=False):
+        """ path to neighbor lists, without extension (.npy data, .yml meta) """
+        gdir = GRAPH_DIR.format(os.path.splitext(cls.data_paths[data_idx])[0])
+        name = f'knn{K}'
+        if radius is not None:
+            name += f'_r{radius:g}'
+        if boxsize is not None:
+            name += f'_pbc{boxsize:g}'
+        if eps:
+            name += f'_eps{eps:g}'
+        if compact:
+            name += '_u16'
+        return f'{gdir}/{name}'
+
+    @classmethod
+    def load_graphs(cls, data_idx, K, boxsize=None, radius=None, eps=0, perm=None,
+                    compact=False):
+        """ open dataset's neighbor lists, or None if they are missing or stale """
+        path = cls.get_graph_path(data_idx, K, boxsize, radius, eps, compact)
+        if not os.path.exists(path + '.yml'):
+            print("\nNo neighbor lists at:\n\t" + path + '\n')
+            return None
+        if R_yml(path + '.yml')['source'] != cls.get_cache_meta(data_idx):
+            print("\nStale neighbor lists, not used:\n\t" + path + '\n')
+            return None
+        print("\nOpened neighbor lists:\n\t" + path + '\n')
+        return NeighborStore(path + '.npy', perm)
+
+    def open_graphs(self, K, boxsize=None, radius=None, eps=0, compact=False):
+        """ open the precomputed neighbor lists for get_graph_batch
+
+        If compact, the uint16 lists are opened, and batches are fed as is,
+        eg to graph.tf_compact_to_coo
+        """
+        self.graphs = self.load_graphs(self.data_idx, K, boxsize, radius, eps,
+                                       self.perm, compact)
+        if self.graphs is None:
+            raise FileNotFoundError(f'No valid neighbor lists for ZA_{ZA_LABELS[self.data_idx]},'
+                                    ' run make_graphs.py')
+
+    def get_graph_batch(self, idx):
+        """ neighbor lists of samples idx; (b, N, K), see open_graphs """
+        return self.graphs[idx]
+
+
+class StreamingSamples:
+    """ samples streamed from several datasets through an LRU sample cache
+
+    Sample j is sample j - offsets[i] of source i. Sources are sample stores
+    or memory-mapped caches if valid, else raw files, and decoded samples are
+    held in a bounded LRU cache, so memory is fixed regardless of how many
+    datasets are streamed.
+
+    Params
+    ------
+    sources : list(ndarray | MemmapSamples | SampleStore)
+        per-dataset samples, indexed like (n_i, N, 6)
+
+    cache_size : int
+        max number of decoded samples held in memory
+
+    num_threads : int
+        number of threads reading uncached samples in parallel; each
+        process (eg forked BatchPrefetcher workers) gets its own pool
+    """
+    def __init__(self, sources, cache_size=SAMPLE_CACHE_SIZE, num_threads=4):
+        self.sources = sources
+        self.offsets = np.cumsum([0] + [len(x) for x in sources])
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.num_threads = num_threads
+        self.pid = None
+        self.check_process()
+        self.hits = self.misses = 0
+
+    def check_process(self):
+        """ new read pool and lock if in a forked child, which has none of
+        the parent's pool threads, and may have inherited a held lock
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.pool = ThreadPoolExecutor(self.num_threads)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self), Dataset.num_particles, 6)
+
+    def read_sample(self, j):
+        """ read and decode sample j from its source (no caching) """
+        i = np.searchsorted(self.offsets, j, side='right') - 1
+        return np.array(self.sources[i][j - self.offsets[i]], dtype=np.float32)
+
+    def read(self, idx):
+        """ list of samples idx; uncached samples are read in parallel """
+        self.check_process()
+        idx = [int(j) for j in idx]
+        with self.lock:
+            found = {j: self.cache[j] for j in idx if j in self.cache}
+            for j in found:
+                self.cache.move_to_end(j)
+            self.hits += len(found)
+        missing = sorted(set(idx) - found.keys())
+        for j, x in zip(missing, self.pool.map(self.read_sample, missing)):
+            found[j] = x
+        with self.lock:
+            self.misses += len(missing)
+            for j in missing:
+                self.cache[j] = found[j]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [found[j] for j in idx]
+
+    def __getitem__(self, j):
+        return self.read([j])[0]
+
+
+class MultiDataset(Dataset):
+    """ Dataset over several simulations at once, streamed from disk
+
+    Each dataset is split exactly like Dataset splits it (same seed), and the
+    splits are concatenated, so the val/test samples of every simulation
+    stay out of training. Batching interface is the same as Dataset.
+
+    Params
+    ------
+    data_idxs : list(int)
+        indices of the datasets, eg [0, 1, 2] for ZA_001, ZA_002, ZA_003
+
+    cache : bool
+        stream processed samples from the dataset caches, where valid
+        (they are not built here; see Dataset(cache=True))
+
+    store : bool
+        stream samples from the dataset sample stores, where valid
+        (takes precedence over cache)
+    """
+    def __init__(self, data_idxs, num_test=num_test_samples, cache=False,
+                 store=False, morton=False, cache_size=SAMPLE_CACHE_SIZE,
+                 num_threads=4):
+        self.data_idxs = list(data_idxs)
+        self.data_idx  = self.data_idxs[0]
+        self.num_test = num_test
+        self.mmap = True
+        self.set_particle_order(morton)
+        def open_source(i):
+            X = self.load_store(i) if store else None
+            if X is None and cache:
+                X = self.load_cache(i)
+            return self.open_data(i) if X is None else X
+        with ThreadPoolExecutor(num_threads) as pool: # parallel opens
+            sources = list(pool.map(open_source, self.data_idxs))
+        self.X = StreamingSamples(sources, cache_size, num_threads)
+
+        #=== per dataset splits, offset into X
+        splits = [[], [], []]
+        for offset, x in zip(self.X.offsets, sources):
+            for split, idx in zip(splits, self.split_dataset(len(x), num_test)):
+                split.append(idx + offset)
+        self.train_idx, self.val_idx, self.test_idx = map(np.concatenate, splits)
+
+    def get_batch(self, idx):
+        """ model-ready batch of samples idx """
+        samples = self.X.read(idx)
+        return self.assemble_batch(samples, range(len(samples)), self.perm)
+
+    def get_buffered_batch(self, idx, buffers):
+        """ model input and target batches of samples idx, in buffers """
+        samples = self.X.read(idx)
+        return buffers.assemble(samples, range(len(samples)))
+
+    def open_graphs(self, K, boxsize=None, radius=None, eps=0, compact=False):
+        """ open the precomputed neighbor lists of every dataset """
+        graphs = [self.load_graphs(i, K, boxsize, radius, eps, self.perm, compact)
+                  for i in self.data_idxs]
+        if any(g is None for g in graphs):
+            raise FileNotFoundError('No valid neighbor lists for some datasets,'
+                                    ' run make_graphs.py')
+        self.graphs = graphs
+
+    def get_graph_batch(self, idx):
+        """ neighbor lists of samples idx, read from each sample's dataset """
+        offsets = self.X.offsets
+        src = np.searchsorted(offsets, idx, side='right') - 1
+        return np.stack([self.graphs[i][j - offsets[i]] for i, j in zip(src, idx)])
+
+
+class DeviceData:
+    """ device-resident training split, with minibatches sampled in-graph
+
+    The training samples are copied once into a (local, non-checkpointed)
+    tf variable; each evaluation of x_za/x_fpm draws a new random batch,
+    gathers it, and joins the grid, all on device, so training steps
+    need no feed_dict. Batches can still be fed explicitly through x_za
+    and x_fpm, eg for evaluation.
+
+    Params
+    ------
+    dataset : Dataset
+        dataset whose training split is loaded to device
+
+    batch_size : int
+        number of samples per minibatch
+
+    seed : int
+        op seed for in-graph sampling
+
+    Attrs
+    -----
+    x_za : tensor; (b, N, 6)
+        model input batch, [grid pos, ZA displacement]
+
+    x_fpm : tensor; (b, N, 3)
+        target batch, FPM displacement - ZA displacement
+    """
+    def __init__(self, dataset, batch_size=batch_size, seed=None):
+        train_idx = np.sort(dataset.train_idx)
+        perm = dataset.perm
+        self.X = np.empty((len(train_idx),) + dataset.X.shape[1:], dtype=np.float32)
+        for i, j in enumerate(train_idx): # host copy, until initialize
+            self.X[i] = dataset.X[j] if perm is None else dataset.X[j][perm]
+        grid = Dataset.grid if perm is None else Dataset.grid[perm]
+        self.X_init = tf.placeholder(tf.float32, shape=self.X.shape)
+        self.X_var  = tf.Variable(self.X_init, trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                  name='device_data')
+
+        #=== in-graph sampling
+        num_train = self.X.shape[0]
+        idx = tf.random_shuffle(tf.range(num_train), seed=seed)[:batch_size]
+        x = tf.gather(self.X_var, idx) # (b, N, 6)
+        grid = tf.broadcast_to(tf.constant(grid), tf.shape(x[...,:3]))
+        self.x_za  = tf.concat([grid, x[...,:3]], axis=-1)
+        self.x_fpm = x[...,3:]
+
+    def initialize(self, sess):
+        """ copy training split to device; call once session is initialized """
+        sess.run(self.X_var.initializer, feed_dict={self.X_init: self.X})
+        del self.X
+        print('\nTraining data loaded to device\n')
+
+
+class EpochSampler:
+    """ epoch-based shuffled minibatch sampler with resumable state
+
+    Each epoch is a full permutation of indices, drawn from the sampler's
+    own rng stream seeded by (seed, epoch), and cut into contiguous blocks
+    of batch_size (a final partial block is dropped). Indices are sorted
+    within each block, for memory-map locality.
+
+    Batch k depends only on (indices, batch_size, seed, k), and the batch
+    position is held in shared memory, so threads and forked processes
+    drawing from one sampler never repeat a batch, and a restored position
+    continues the exact same stream.
+
+    Params
+    ------
+    indices : ndarray.int
+        sample indices to draw from, eg dataset.train_idx
+
+    batch_size : int
+        number of samples per batch
+
+    seed : int
+        seed for this sampler's rng stream
+
+    position : int
+        number of batches already drawn, eg restored from a checkpoint
+    """
+    def __init__(self, indices, batch_size=batch_size, seed=DATASET_SEED, position=0):
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.batches_per_epoch = len(self.indices) // batch_size
+        assert self.batches_per_epoch > 0, 'batch_size larger than indices'
+        self._position = multiprocessing.Value('q', position)
+        self._perm = (None, None) # (epoch, permutation), cached per process
+
+    @property
+    def position(self):
+        return self._position.value
+
+    @property
+    def epoch(self):
+        return self.position // self.batches_per_epoch
+
+    def get_permutation(self, epoch):
+        if self._perm[0] != epoch:
+            rng = np.random.RandomState([self.seed, epoch])
+            self._perm = (epoch, self.indices[rng.permutation(len(self.indices))])
+        return self._perm[1]
+
+    def get_batch(self, k):
+        """ sorted sample indices of the k-th batch of the stream """
+        epoch, cursor = divmod(k, self.batches_per_epoch)
+        p = cursor * self.batch_size
+        return np.sort(self.get_permutation(epoch)[p:p + self.batch_size])
+
+    def __next__(self):
+        with self._position.get_lock():
+            k = self._position.value
+            self._position.value += 1
+            return self.get_batch(k)
+
+    def __iter__(self):
+        return self
+
+    def state_dict(self, position=None):
+        position = self.position if position is None else position
+        return dict(seed=self.seed, batch_size=self.batch_size,
+                    num_indices=len(self.indices), position=int(position))
+
+    def load_state_dict(self, state):
+        cur = self.state_dict()
+        for key in ('seed', 'batch_size', 'num_indices'):
+            if state[key] != cur[key]:
+                raise ValueError(f'sampler {key} mismatch: {state[key]} != {cur[key]}')
+        self._position.value = state['position']
+
+
+#-----------------------------------------------------------------------------#
+#                              Data augmentation                              #
+#-----------------------------------------------------------------------------#
+"""
+The simulations are periodic cubes, so each sample is equally valid after
+any of the 48 symmetries of the cube (axis permutations and flips) and any
+periodic translation by whole grid cells.
+
+Particles are stored in (fixed) grid order, so a transformed sample keeps
+the same grid positions, while the displacement vectors are rotated/flipped
+and moved to the particle slot whose grid cell they were mapped onto.
+"""
+
+def get_cube_symmetries():
+    """ the 48 cube symmetries, as signed permutation matrices; (48, 3, 3) """
+    mats = []
+    for perm in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            R = np.zeros((3, 3), dtype=np.int64)
+            R[range(3), perm] = signs
+            mats.append(R)
+    return np.array(mats)
+
+CUBE_SYMMETRIES = get_cube_symmetries()
+GRID_SIDE  = 32 # particles per side of the Lagrangian grid
+GRID_CELLS = ((Dataset.grid + 62) // 4).astype(np.int64) # (N, 3), grid coords in [0, 32)
+CELL_TO_IDX = np.zeros((GRID_SIDE,)*3, dtype=np.int64)   # grid coords ---> particle idx
+CELL_TO_IDX[tuple(GRID_CELLS.T)] = np.arange(len(GRID_CELLS))
+
+
+def augment_batch(x, symmetries=True, translations=True, perm=None, rng=np.random):
+    """ random cube symmetry and periodic translation for each sample in batch
+
+    The whole batch is transformed at once, so this can run as a
+    BatchPrefetcher preprocessor (before split_batch).
+
+    Params
+    ------
+    x : ndarray.float32; (b, N, 9)
+        batch, [grid pos, ZA displacement, FPM displacement - ZA displacement]
+
+    symmetries : bool
+        apply a random one of the 48 axis permutations/flips
+
+    translations : bool
+        apply a random periodic translation by whole grid cells
+
+    perm : ndarray.int; (N,)
+        particle order of x, eg Dataset.perm; grid order if None
+
+    Returns
+    -------
+    x_aug : ndarray.float32; (b, N, 9)
+        transformed batch; grid positions are unchanged
+    """
+    b = x.shape[0]
+    zeros = np.zeros(b, dtype=np.int64)
+    R = CUBE_SYMMETRIES[rng.randint(48, size=b) if symmetries else zeros] # [0] is identity
+    t = rng.randint(GRID_SIDE, size=(b, 3)) if translations else zeros[:,None]
+
+    cells, cell_to_idx = GRID_CELLS, CELL_TO_IDX
+    if perm is not None:
+        cells, cell_to_idx = GRID_CELLS[perm], np.argsort(perm)[CELL_TO_IDX]
+
+    #=== source particle of each output slot; invert c' = R.(c - 15.5) + 15.5 + t
+    c = (cells - t[:,None]) % GRID_SIDE   # (b, N, 3)
+    v = np.einsum('bji,bnj->bni', R, 2*c - (GRID_SIDE - 1)) # R^T, in odd centered coords
+    src = cell_to_idx[tuple(np.moveaxis((v + GRID_SIDE - 1) // 2, -1, 0))] # (b, N)
+
+    #=== gather and transform displacement vectors
+    disp = np.take_along_axis(x[...,3:], src[...,None], axis=1).reshape(b, -1, 2, 3)
+    disp = np.einsum('bij,bnkj->bnki', R.astype(x.dtype), disp)
+
+    x_aug = np.empty_like(x)
+    x_aug[...,:3] = x[...,:3]
+    x_aug[...,3:] = disp.reshape(b, -1, 6)
+    return x_aug
+
+
+#-----------------------------------------------------------------------------#
+#                               Particle order                                #
+#-----------------------------------------------------------------------------#
+
+def get_morton_order(cells):
+    """ permutation that sorts integer grid cells along a Morton (Z-order) curve
+
+    Params
+    ------
+    cells : ndarray.int; (N, 3)
+        grid coords, eg GRID_CELLS
+
+    Returns
+    -------
+    perm : ndarray.int; (N,)
+        cells[perm] is in Morton order
+    """
+    bits = int(cells.max()).bit_length()
+    code = np.zeros(len(cells), dtype=np.int64)
+    for b in range(bits): # interleave bits: ... z1 y1 x1 z0 y0 x0
+        for d in range(3):
+            code |= ((cells[:, d] >> b) & 1) << (3*b + d)
+    return np.argsort(code, kind='stable')
+
+MORTON_PERM = get_morton_order(GRID_CELLS) # grid order ---> Morton order
+MORTON_INV  = np.argsort(MORTON_PERM)      # Morton order ---> grid order
+
+
+#-----------------------------------------------------------------------------#
+#                               Batch prefetching                             #
+#-----------------------------------------------------------------------------#
+
+class BatchBuffers:
+    """ pool of preallocated, contiguous model input and target batch buffers
+
+    Batches are gathered straight into a free slot of the pool, and the
+    grid positions are written into every input slot only once, so batch
+    assembly does no large allocations in the training loop.
+
+    A slot is only reused once its batch is released by the consumer
+    (`release`), and `assemble` blocks until a slot is free, so batches
+    in flight are never overwritten. num_buffers only bounds how many
+    batches are in flight, eg prefetch depth + workers + 1 keeps the
+    prefetch workers from waiting on slots.
+
+    Slots are tracked in this process only, so buffers are for threads
+    (eg BatchPrefetcher default workers), not BatchPrefetcher(processes=True).
+
+    Params
+    ------
+    batch_size : int
+        number of samples per batch; buffers are reallocated (once) if a
+        larger batch is assembled
+
+    num_buffers : int
+        number of (input, target) slots in the pool
+
+    perm : ndarray.int; (N,)
+        particle order of the batches, eg Dataset.perm; grid order if None
+    """
+    def __init__(self, batch_size=batch_size, num_buffers=2, perm=None):
+        self.num_buffers = num_buffers
+        self.perm = perm
+        self._free = queue.Queue() # ids of released slots
+        for k in range(num_buffers):
+            self._free.put(k)
+        self._held = {} # id(x_in) ---> slot
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.allocate(batch_size)
+
+    def allocate(self, batch_size):
+        N = Dataset.num_particles
+        self.inputs  = np.empty((self.num_buffers, batch_size, N, 6), dtype=np.float32)
+        self.targets = np.empty((self.num_buffers, batch_size, N, 3), dtype=np.float32)
+        self.inputs[...,:3] = Dataset.grid if self.perm is None else Dataset.grid[self.perm]
+        if self.perm is not None: # per slot, for permuting samples without allocs
+            self.scratch = np.empty((self.num_buffers, N, 6), dtype=np.float32)
+
+    def assemble(self, X, idx):
+        """ gather samples idx of grid-free X into a free slot, blocking
+        until one is released; release the batch once it has been used
+
+        Params
+        ------
+        X : ndarray.float32; (n, N, 6) | MemmapSamples | SampleStore | list
+            grid-free samples, eg Dataset.X
+
+        idx : ndarray.int; (b,)
+            sample indices into X
+
+        Returns
+        -------
+        x_in : ndarray.float32; (b, N, 6)
+            model input, [grid pos, ZA displacement]
+
+        y : ndarray.float32; (b, N, 3)
+            target, FPM displacement - ZA displacement
+        """
+        self.check_process()
+        k = self._free.get()
+        b = len(idx)
+        if b > self.inputs.shape[1]:
+            with self._lock:
+                if b > self.inputs.shape[1]:
+                    self.allocate(b)
+        x_in, y = self.inputs[k, :b], self.targets[k, :b]
+        try:
+            # NB: per-sample copyto, since np.take(X[...,:3], out=...) first
+            #     makes the whole strided X[...,:3] contiguous
+            for i, j in enumerate(idx):
+                sample = X[j] # a view, for in memory/cached/shared X
+                if self.perm is not None:
+                    sample = np.take(sample, self.perm, axis=0, out=self.scratch[k], mode='clip')
+                np.copyto(x_in[i,:,3:], sample[:,:3])
+                np.copyto(y[i], sample[:,3:])
+        except BaseException:
+            self._free.put(k)
+            raise
+        with self._lock:
+            self._held[id(x_in)] = k
+        return x_in, y
+
+    def release(self, x_in):
+        """ return the slot of an assembled batch (its x_in) to the pool,
+        once the batch is used, eg after the training step it was fed to
+        """
+        self.check_process()
+        with self._lock:
+            k = self._held.pop(id(x_in))
+        self._free.put(k)
+
+    def check_process(self):
+        assert os.getpid() == self._pid, \
+            'BatchBuffers are thread-only, not for BatchPrefetcher(processes=True)'
+
+
+def split_batch(x):
+    """ per-batch preprocessor: (b, N, 9) ---> model input (b, N, 6), target (b, N, 3)
+    both contiguous, so feeding them to tf does not copy again
+    """
+    return np.ascontiguousarray(x[...,:6]), np.ascontiguousarray(x[...,6:])
+
+
+class BatchPrefetcher:
+    """ background producer of fully-formed training batches
+
+    Workers repeatedly call `get_batch`, pass the batch through each of the
+    `preprocessors` in order, and put the result in a bounded queue, so the
+    next `depth` batches are ready before the training step asks for them.
+
+    Params
+    ------
+    get_batch : callable
+        no-arg function returning a new batch, eg dataset.get_minibatch
+
+    preprocessors : list(callable)
+        per-batch funcs, run in the workers: batch = f(batch)
+        eg split_batch, or graph.kneighbor_coo_preprocessor(M)
+
+    depth : int
+        max number of prepared batches waiting in the queue
+
+    num_workers : int
+        number of worker threads (or processes)
+
+    processes : bool
+        use forked worker processes instead of threads; useful when the
+        preprocessors hold the GIL (eg, pure python graph building).
+        Each worker process reseeds np.random with seed + worker id.
+
+    seed : int
+        base seed for worker processes
+    """
+    def __init__(self, get_batch, preprocessors=(), depth=4, num_workers=2,
+                 processes=False, seed=DATASET_SEED):
+        self.get_batch = get_batch
+        self.preprocessors = list(preprocessors)
+        self.wait_time = 0.  # seconds the consumer spent blocked on the queue
+        self.num_batches = 0 # batches handed out
+        if processes:
+            ctx = multiprocessing.get_context('fork')
+            self.queue = ctx.Queue(maxsize=depth)
+            self.stop  = ctx.Event()
+            self.workers = [ctx.Process(target=self._work, args=(seed + i,), daemon=True)
+                            for i in range(num_workers)]
+        else:
+            self.queue = queue.Queue(maxsize=depth)
+            self.stop  = threading.Event()
+            self.workers = [threading.Thread(target=self._work, daemon=True)
+                            for i in range(num_workers)]
+        for w in self.workers:
+            w.start()
+
+    def _work(self, seed=None):
+        if seed is not None: # forked process, don't share parent rng stream
+            np.random.seed(seed)
+        while not self.stop.is_set():
+            try:
+                batch = self.get_batch()
+                for f in self.preprocessors:
+                    batch = f(batch)
+            except Exception as e: # re-raised by consumer
+                batch = e
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+        """ next prepared batch; blocks until one is ready """
+        t = time.time()
+        batch = self.queue.get()
+        self.wait_time += time.time() - t
+        self.num_batches += 1
+        if isinstance(batch, Exception):
+            self.close()
+            raise batch
+        return batch
+
+    __next__ = get
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.stop.set()
+        for w in self.workers:
+            w.join(timeout=1)
+            if isinstance(w, multiprocessing.process.BaseProcess) and w.is_alive():
+                w.terminate()
+
+    def print_wait_stats(self):
+        """ how long the training loop has spent waiting on batches """
+        n = max(self.num_batches, 1)
+        print(f"\tbatch wait: {self.wait_time:.2f}s total, "
+              f"{1e3 * self.wait_time / n:.2f}ms/batch over {self.num_batches} batches")
+
 
 def get_init_pos(za_disp):
     b, N, k = za_disp.shape